@@ -0,0 +1,264 @@
+#!python3
+
+import contextlib
+import json
+import os
+import random
+import resource
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import yaml
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import mediascan
+from iosched import DeviceScheduler
+
+##
+# Benchmark for mediascan and mediareport. Builds a synthetic library, probes it with a stub ffprobe
+# that returns canned JSON after a configurable delay, and times each phase against SQLite.
+# Results are written as JSON so runs before and after a change can be compared.
+##
+
+STUB = """#!{python}
+import json, sys, time, zlib
+path = sys.argv[sys.argv.index("-i") + 1]
+time.sleep({latency})
+h = zlib.crc32(path.encode())
+video = {{"index": 0, "codec_type": "video", "codec_name": ("hevc", "h264", "mpeg4")[h % 3],
+          "width": (1920, 1280, 3840)[h % 3], "height": (1080, 720, 2160)[h % 3], "r_frame_rate": "24000/1001",
+          "pix_fmt": ("yuv420p", "yuv420p10le")[h % 2],
+          "tags": {{"BPS": str(1000000 + h % 4000000), "DURATION": "00:42:10.000000000", "language": "eng"}}}}
+streams = [video, {{"index": 1, "codec_type": "audio", "codec_name": "ac3", "channel_layout": "5.1(side)",
+                    "disposition": {{"default": 1}}, "tags": {{"language": "eng"}}}}]
+if h % 4 == 0:
+    streams.append({{"index": 2, "codec_type": "audio", "codec_name": "aac", "channels": 2,
+                     "disposition": {{"default": 0}}, "tags": {{"language": "jpn"}}}})
+streams.append({{"index": len(streams), "codec_type": "subtitle", "codec_name": "subrip",
+                 "disposition": {{"default": 0}}, "tags": {{"language": "eng"}}}})
+print(json.dumps({{"streams": streams}}))
+"""
+
+SOURCES = ["Bluray-1080p", "WEBDL-1080p", "WEBRip-1080p", "HDTV-720p", "DVD"]
+
+queries = 0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    global queries
+    queries += 1
+
+
+class Phases:
+    """Accumulates time, calls and queries for wrapped functions"""
+
+    def __init__(self):
+        self.totals: Dict[str, Dict] = {}
+
+    def wrap(self, name: str, fn):
+        def timed(*args, **kwargs):
+            start, start_queries = time.perf_counter(), queries
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                total = self.totals.setdefault(name, {"seconds": 0.0, "calls": 0, "queries": 0})
+                total["seconds"] += time.perf_counter() - start
+                total["calls"] += 1
+                total["queries"] += queries - start_queries
+        return timed
+
+    def take(self) -> Dict[str, Dict]:
+        totals = self.totals
+        for total in totals.values():
+            total["seconds"] = round(total["seconds"], 3)
+        self.totals = {}
+        return totals
+
+
+def peak_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_file(path: str):
+    # sparse, so the library takes no space but still has plausible sizes
+    with open(path, "wb") as f:
+        f.truncate(random.randint(200, 4000) * 1024 * 1024)
+
+
+def build_library(root: str, shows: int, seasons: int, episodes: int, movies: int) -> int:
+    random.seed(1)
+    count = 0
+    for s in range(shows):
+        for season in range(1, seasons + 1):
+            folder = os.path.join(root, "Television", f"Show {s}", f"Season {season}")
+            os.makedirs(folder)
+            for e in range(1, episodes + 1):
+                ext = random.choice(mediascan.EXTENSIONS)
+                make_file(os.path.join(folder, f"Show {s} - S{season:02}E{e:02} - Title [{random.choice(SOURCES)}]{ext}"))
+                count += 1
+            open(os.path.join(folder, "folder.jpg"), "wb").close()
+    for m in range(movies):
+        folder = os.path.join(root, "Movies", f"Movie {m} ({1950 + m % 70})")
+        os.makedirs(folder)
+        make_file(os.path.join(folder, f"Movie {m} ({1950 + m % 70}) {random.choice(SOURCES)}{random.choice(mediascan.EXTENSIONS)}"))
+        open(os.path.join(folder, "movie.nfo"), "wb").close()
+        count += 1
+    return count
+
+
+def remove_some(root: str, fraction: float) -> int:
+    """Delete a fraction of the episodes and one whole season, returns the number of files removed"""
+    removed = 0
+    for show in sorted(os.listdir(os.path.join(root, "Television"))):
+        for season in sorted(os.listdir(os.path.join(root, "Television", show))):
+            folder = os.path.join(root, "Television", show, season)
+            for filename in sorted(os.listdir(folder)):
+                if filename[-4:] in mediascan.EXTENSIONS and random.random() < fraction:
+                    os.remove(os.path.join(folder, filename))
+                    removed += 1
+    folder = os.path.join(root, "Television", "Show 0", "Season 1")
+    removed += sum(1 for filename in os.listdir(folder) if filename[-4:] in mediascan.EXTENSIONS)
+    shutil.rmtree(folder)
+    return removed
+
+
+def run_scan(name: str, phases: Phases, paths: List[Dict], files: int, jobs: int, mode: str) -> Dict:
+    mediascan.mode = mode
+    start, start_queries = time.perf_counter(), queries
+    with ThreadPoolExecutor(max_workers=jobs) as executor, open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        # probes go through the per-disk scheduler as they do in mediascan.py, with the default devices settings
+        mediascan.scheduler = DeviceScheduler(executor, jobs, jobs)
+        mediascan.scan(paths, executor)
+    mediascan.scheduler = None
+    seconds = time.perf_counter() - start
+    return {"run": name, "mode": mode, "files": files, "seconds": round(seconds, 3),
+            "files_per_s": round(files / seconds, 1) if seconds else None,
+            "queries": queries - start_queries, "phases": phases.take(), "peak_rss_mb": peak_rss_mb()}
+
+
+def run_report(name: str, args: List[str]) -> Dict:
+    start, start_queries = time.perf_counter(), queries
+    argv = sys.argv
+    sys.argv = ["mediareport.py"] + args
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            runpy.run_path(report_script, run_name="__main__")
+    finally:
+        sys.argv = argv
+    return {"run": name, "seconds": round(time.perf_counter() - start, 3), "queries": queries - start_queries,
+            "peak_rss_mb": peak_rss_mb()}
+
+
+if __name__ == "__main__":
+
+    shows = 50
+    seasons = 4
+    episodes = 10
+    movies = 200
+    latency = 0.0
+    jobs = 4
+    batch_size = 0
+    output = "benchmark.json"
+    keep = None
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--shows":
+            shows = int(next(args))
+        elif arg == "--seasons":
+            seasons = int(next(args))
+        elif arg == "--episodes":
+            episodes = int(next(args))
+        elif arg == "--movies":
+            movies = int(next(args))
+        elif arg == "--latency":
+            latency = float(next(args))
+        elif arg == "--jobs":
+            jobs = int(next(args))
+        elif arg == "--batch-size":
+            batch_size = int(next(args))
+        elif arg == "--output":
+            output = next(args)
+        elif arg == "--keep":
+            keep = os.path.abspath(next(args))
+
+    if keep and os.path.exists(keep):
+        print(f"{keep} already exists")
+        sys.exit(1)
+
+    output = os.path.abspath(output)
+    report_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mediareport.py")
+    workdir = keep or tempfile.mkdtemp(prefix="mediascan-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    stub = os.path.join(workdir, "ffprobe")
+    with open(stub, "w") as f:
+        f.write(STUB.format(python=sys.executable, latency=latency))
+    os.chmod(stub, 0o755)
+
+    root = os.path.join(workdir, "library")
+    files = build_library(root, shows, seasons, episodes, movies)
+    paths = [{"path": os.path.join(root, "Television"), "type": "tv"},
+             {"path": os.path.join(root, "Movies"), "type": "movie"}]
+    db_url = "sqlite:///" + os.path.join(workdir, "mediascan.db")
+    with open("mediascan.yml", "w") as f:
+        yaml.dump({"paths": paths, "database": [{"connect": db_url}]}, f)
+
+    # every file goes to the stub, the probe cache would hide the cost being measured
+    mediascan.FFPROBE_PATH = stub
+    mediascan.probe_cache = None
+    mediascan.jobs = jobs
+    if batch_size > 0:
+        mediascan.bulk_writer = mediascan.BulkWriter(batch_size)
+
+    phases = Phases()
+    mediascan.dig = phases.wrap("dig", mediascan.dig)
+    mediascan.store = phases.wrap("store", mediascan.store)
+    mediascan.purge = phases.wrap("purge", mediascan.purge)
+    mediascan.commit = phases.wrap("commit", mediascan.commit)
+    mediascan.BulkWriter.flush = phases.wrap("flush", mediascan.BulkWriter.flush)
+
+    engine = mediascan.create_db_engine(db_url)
+    mediascan.upgrade_schema(engine)
+    mediascan.Base.metadata.create_all(engine)
+
+    runs = []
+    with Session(engine) as session:
+        mediascan.session = session
+        runs.append(run_scan("initial", phases, paths, files, jobs, "add"))
+        runs.append(run_scan("unchanged", phases, paths, files, jobs, "add"))
+        runs.append(run_scan("unchanged deep", phases, paths, files, jobs, "deep"))
+        removed = remove_some(root, 0.1)
+        runs.append(run_scan("purge", phases, paths, files - removed, jobs, "add"))
+        runs[-1]["removed"] = removed
+    engine.dispose()
+
+    runs.append(run_report("report full", ["-f"]))
+    runs.append(run_report("report incremental", []))
+
+    results = {
+        "library": {"shows": shows, "seasons": seasons, "episodes": episodes, "movies": movies, "files": files},
+        "latency": latency,
+        "jobs": jobs,
+        "batch_size": batch_size,
+        "runs": runs,
+    }
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for run in runs:
+        print(f"{run['run']:>20}: {run['seconds']:8.3f}s {run['queries']:7} queries "
+              f"{run.get('files_per_s') or '':>8} files/s {run['peak_rss_mb']:8} MB")
+    print(f"results written to {output}")
+
+    if not keep:
+        shutil.rmtree(workdir)
@@ -0,0 +1,164 @@
+import os
+import struct
+import tempfile
+import unittest
+
+import containers
+
+##
+# Hand-built Matroska and MP4 headers, just big enough for containers.probe() to read
+##
+
+
+def bits(*fields) -> bytes:
+    """Pack (value, width) fields, or ("ue", value) exp-golomb codes, MSB first with a stop bit at the end"""
+    out = ""
+    for kind, value in fields:
+        if kind == "ue":
+            code = bin(value + 1)[2:]
+            out += "0" * (len(code) - 1) + code
+        else:
+            out += format(kind, f"0{value}b")
+    out += "1"
+    out += "0" * (-len(out) % 8)
+    return int(out, 2).to_bytes(len(out) // 8, "big")
+
+
+# 1920x1080 baseline H.264, no VUI
+BASELINE_SPS = b"\x67" + bits((66, 8), (0x001E, 16), ("ue", 0), ("ue", 0), ("ue", 2), ("ue", 1), (0, 1),
+                              ("ue", 119), ("ue", 67), (1, 1), (1, 1), (0, 1), (0, 1))
+# 1920x1080 High 10 H.264 with BT.709 colour
+HIGH10_SPS = b"\x67" + bits((110, 8), (0x0028, 16), ("ue", 0), ("ue", 1), ("ue", 2), ("ue", 2), (0, 1), (0, 1),
+                            ("ue", 0), ("ue", 2), ("ue", 1), (0, 1), ("ue", 119), ("ue", 67), (1, 1), (1, 1), (0, 1),
+                            (1, 1), (0, 1), (0, 1), (1, 1), (5, 3), (0, 1), (1, 1), (1, 8), (1, 8), (1, 8))
+
+
+def avcc(sps: bytes) -> bytes:
+    return bytes([1, sps[1], 0, 30, 0xFF, 0xE1]) + struct.pack(">H", len(sps)) + sps
+
+
+def ebml(element_id: int, *children: bytes) -> bytes:
+    payload = b"".join(children)
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + b"\x01" + len(payload).to_bytes(7, "big") \
+        + payload
+
+
+def ebml_uint(element_id: int, value: int) -> bytes:
+    return ebml(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def ebml_str(element_id: int, value: str) -> bytes:
+    return ebml(element_id, value.encode())
+
+
+# AC-3, 48 kHz, 448 kbps, 3/2 with LFE
+AC3_FRAME = b"\x0b\x77\x00\x00" + bytes([30, 8 << 3, 0b11100001]) + bytes(64)
+
+
+def mkv(codec_id: str = "V_MPEG4/ISO/AVC") -> bytes:
+    tracks = ebml(containers.TRACKS,
+                  ebml(0xAE, ebml_uint(0xD7, 1), ebml_uint(0x73C5, 101), ebml_uint(0x83, 1), ebml_str(0x86, codec_id),
+                       ebml(0x63A2, avcc(BASELINE_SPS)), ebml_uint(0x23E383, 41708333),
+                       ebml(0xE0, ebml_uint(0xB0, 1920), ebml_uint(0xBA, 1080))),
+                  ebml(0xAE, ebml_uint(0xD7, 2), ebml_uint(0x73C5, 102), ebml_uint(0x83, 2), ebml_str(0x86, "A_AC3"),
+                       ebml_str(0x22B59C, "ger"), ebml(0xE1, ebml_uint(0x9F, 2))),
+                  ebml(0xAE, ebml_uint(0xD7, 3), ebml_uint(0x73C5, 103), ebml_uint(0x83, 17),
+                       ebml_str(0x86, "S_TEXT/UTF8"), ebml_uint(0x88, 0), ebml_str(0x536E, "Forced")))
+    tags = ebml(containers.TAGS,
+                ebml(0x7373, ebml(0x63C0, ebml_uint(0x63C5, 101)),
+                     ebml(0x67C8, ebml_str(0x45A3, "BPS"), ebml_str(0x4487, "5000000"))))
+    cluster = ebml(containers.CLUSTER, ebml_uint(0xE7, 0), ebml(0xA3, b"\x82\x00\x00\x80" + AC3_FRAME), bytes(32))
+    return ebml(containers.EBML, ebml_str(0x4282, "matroska")) + ebml(containers.SEGMENT, tracks, tags, cluster)
+
+
+def box(box_type: bytes, *children: bytes) -> bytes:
+    payload = b"".join(children)
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, flags: int, *children: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", flags), *children)
+
+
+def language(code: str) -> int:
+    return sum((ord(c) - 0x60) << shift for c, shift in zip(code, (10, 5, 0)))
+
+
+def mp4_trak(default: bool, timescale: int, duration: int, lang: str, handler: bytes, name: bytes, entry: bytes,
+             stts: bytes, sizes) -> bytes:
+    stbl = box(b"stbl",
+               full_box(b"stsd", 0, struct.pack(">I", 1 if entry else 0), entry),
+               full_box(b"stts", 0, stts),
+               full_box(b"stsz", 0, struct.pack(f">II{len(sizes)}I", 0, len(sizes), *sizes)))
+    return box(b"trak",
+               full_box(b"tkhd", 3 if default else 0, bytes(80)),
+               box(b"mdia",
+                   full_box(b"mdhd", 0, struct.pack(">IIIIHH", 0, 0, timescale, duration, language(lang), 0)),
+                   full_box(b"hdlr", 0, bytes(4), handler, bytes(12), name + b"\0"),
+                   box(b"minf", stbl)))
+
+
+def mp4(empty_stsd: bool = False) -> bytes:
+    compressor = bytes([4]) + b"x264".ljust(31, b"\0")
+    avc1 = box(b"avc1", bytes(24), struct.pack(">HH", 1920, 1080), bytes(14), compressor, bytes(4),
+               box(b"avcC", avcc(HIGH10_SPS)))
+    video = mp4_trak(True, 24000, 24 * 1001, "eng", b"vide", b"VideoHandler", b"" if empty_stsd else avc1,
+                     struct.pack(">III", 1, 24, 1001), [10000] * 24)
+    # ES descriptor > decoder config (AAC, 192 kbps average) > AudioSpecificConfig (LC, 48 kHz, stereo)
+    decoder_config = bytes([0x40, 0x15, 0, 0, 0]) + struct.pack(">II", 256000, 192000) + bytes([5, 2, 0x11, 0x90])
+    es = bytes([0, 1, 0]) + bytes([4, len(decoder_config)]) + decoder_config
+    mp4a = box(b"mp4a", bytes(8), bytes(8), struct.pack(">HHHHI", 2, 16, 0, 0, 48000 << 16),
+               full_box(b"esds", 0, bytes([3, len(es)]) + es))
+    audio = mp4_trak(False, 48000, 48048, "jpn", b"soun", b"SoundHandler", mp4a,
+                     struct.pack(">III", 1, 47, 1024), [600] * 47)
+    mvhd = full_box(b"mvhd", 0, struct.pack(">IIII", 0, 0, 1000, 1001), bytes(80))
+    return box(b"ftyp", b"isom", bytes(4), b"isommp41") + box(b"moov", mvhd, video, audio)
+
+
+class ContainerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def probe(self, name: str, data: bytes):
+        path = os.path.join(self.folder.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return containers.probe(path)
+
+    def test_mkv(self):
+        streams = self.probe("a.mkv", mkv())["streams"]
+        self.assertEqual(streams[0], {"index": 0, "codec_name": "h264", "codec_type": "video", "width": 1920,
+                                      "height": 1080, "pix_fmt": "yuv420p", "r_frame_rate": "24000/1001",
+                                      "disposition": {"default": 1}, "tags": {"language": "eng", "BPS": "5000000"}})
+        self.assertEqual(streams[1], {"index": 1, "codec_name": "ac3", "codec_type": "audio", "channels": 6,
+                                      "channel_layout": "5.1(side)", "bit_rate": "448000",
+                                      "disposition": {"default": 1}, "tags": {"language": "ger"}})
+        self.assertEqual(streams[2], {"index": 2, "codec_name": "subrip", "codec_type": "subtitle",
+                                      "disposition": {"default": 0}, "tags": {"language": "eng", "title": "Forced"}})
+
+    def test_mp4(self):
+        streams = self.probe("a.mp4", mp4())["streams"]
+        self.assertEqual(streams[0], {"index": 0, "codec_name": "h264", "codec_type": "video", "width": 1920,
+                                      "height": 1080, "pix_fmt": "yuv420p10le", "r_frame_rate": "24000/1001",
+                                      "color_space": "bt709", "bit_rate": "1918081", "duration": "1.001000",
+                                      "disposition": {"default": 1},
+                                      "tags": {"language": "eng", "handler_name": "VideoHandler", "encoder": "x264"}})
+        self.assertEqual(streams[1], {"index": 1, "codec_name": "aac", "codec_type": "audio", "channels": 2,
+                                      "channel_layout": "stereo", "bit_rate": "192000", "duration": "1.001000",
+                                      "disposition": {"default": 0},
+                                      "tags": {"language": "jpn", "handler_name": "SoundHandler"}})
+
+    def test_falls_back_to_ffprobe(self):
+        # unfamiliar codec, truncated header, sample description without entries
+        self.assertIsNone(self.probe("b.mkv", mkv("V_MPEG2")))
+        self.assertIsNone(self.probe("c.mkv", mkv()[:60]))
+        self.assertIsNone(self.probe("d.mp4", mp4(empty_stsd=True)))
+        self.assertIsNone(self.probe("e.mp4", b"not a movie"))
+
+
+if __name__ == "__main__":
+    unittest.main()
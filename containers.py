@@ -0,0 +1,925 @@
+import struct
+from fractions import Fraction
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+##
+# Reads stream details straight from Matroska (EBML) and MP4 (ISO-BMFF) headers, so mediascan can
+# skip starting an ffprobe process for most files. The result has the same shape as the output of
+# ffprobe -show_streams, so it goes through the same parsing. Whenever a file needs something only
+# ffprobe would know (an unfamiliar codec, a frame rate that has to be measured, ...) probe()
+# returns None and the caller falls back to ffprobe.
+##
+
+# never read more than this much header, anything bigger is left to ffprobe
+MAX_HEADER = 64 * 1024 * 1024
+# how far into the first clusters to look for the audio frames that carry a bit rate
+MAX_CLUSTER_SCAN = 4 * 1024 * 1024
+
+
+class Unsupported(Exception):
+    pass
+
+
+COLOR_SPACES = {0: "gbr", 1: "bt709", 4: "fcc", 5: "bt470bg", 6: "smpte170m", 7: "smpte240m", 8: "ycgco",
+                9: "bt2020nc", 10: "bt2020c", 11: "smpte2085", 12: "chroma-derived-nc", 13: "chroma-derived-c",
+                14: "ictcp"}
+
+MKV_CODECS = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_AAC": "aac",
+    "A_AAC/MPEG2/LC": "aac",
+    "A_AAC/MPEG4/LC": "aac",
+    "A_OPUS": "opus",
+    "S_TEXT/UTF8": "subrip",
+    "S_TEXT/ASS": "ass",
+    "S_TEXT/SSA": "ass",
+    "S_ASS": "ass",
+    "S_SSA": "ass",
+    "S_TEXT/WEBVTT": "webvtt",
+    "S_HDMV/PGS": "hdmv_pgs_subtitle",
+    "S_HDMV/TEXTST": "hdmv_text_subtitle",
+    "S_VOBSUB": "dvd_subtitle",
+    "S_DVBSUB": "dvb_subtitle",
+}
+
+MP4_CODECS = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"mp4a": "aac",
+    b"ac-3": "ac3",
+    b"ec-3": "eac3",
+    b"Opus": "opus",
+    b"tx3g": "mov_text",
+}
+
+CHANNEL_LAYOUTS = {1: "mono", 2: "stereo", 6: "5.1", 8: "7.1"}
+# (acmod, lfeon) of an AC-3 or E-AC-3 stream
+AC3_LAYOUTS = {(1, 0): ("mono", 1), (2, 0): ("stereo", 2), (2, 1): ("2.1", 3), (7, 0): ("5.0(side)", 5),
+               (7, 1): ("5.1(side)", 6)}
+AC3_BIT_RATES = [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 448, 512, 576, 640]
+AC3_SAMPLE_RATES = [48000, 44100, 32000]
+
+
+def probe(path: str) -> Optional[Dict]:
+    """Stream details of an .mkv, .mp4 or .m4v file in ffprobe's JSON layout, or None if ffprobe is needed"""
+    ext = path[-4:].lower()
+    try:
+        with open(path, "rb") as f:
+            if ext == ".mkv":
+                return {"streams": mkv_streams(f)}
+            if ext in (".mp4", ".m4v"):
+                return {"streams": mp4_streams(f)}
+    except (Unsupported, OSError, ValueError, KeyError, IndexError, TypeError, ZeroDivisionError, StopIteration,
+            struct.error):
+        # missing boxes and elements, odd sizes, truncated files: leave them to ffprobe
+        pass
+    return None
+
+
+# besides multiples of 1/12, the rates libavformat settles on when it estimates r_frame_rate
+NTSC_RATES = [Fraction(n * 1000, 1001) for n in (12, 15, 24, 30, 48, 60)]
+
+
+def frame_rate(num: int, den: int) -> str:
+    # container timing is rounded (to the nanosecond in Matroska), so snap to the nearest standard rate
+    rate = Fraction(num, den)
+    candidates = NTSC_RATES + [Fraction(max(1, round(rate * 12)), 12)]
+    nearest = min(candidates, key=lambda standard: abs(standard - rate))
+    if abs(nearest - rate) > rate / 100000:
+        raise Unsupported("frame rate has to be measured")
+    return f"{nearest.numerator}/{nearest.denominator}"
+
+
+##
+# H.264 and HEVC parameter sets, for the pixel format and colour space the decoder would report
+##
+
+class BitReader:
+
+    def __init__(self, nal: bytes):
+        # drop emulation prevention bytes (00 00 03)
+        self.data = nal.replace(b"\x00\x00\x03", b"\x00\x00")
+        self.pos = 0
+
+    def u(self, n: int) -> int:
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def skip(self, n: int):
+        self.pos += n
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("bad exp-golomb code")
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def pix_fmt(chroma_format: int, bit_depth: int, full_range: bool, matrix: Optional[int],
+            jpeg_formats: Tuple[int, ...]) -> str:
+    if chroma_format == 3 and matrix == 0:
+        name = "gbrp"
+    elif chroma_format == 0:
+        name = "gray"
+    else:
+        name = ("yuv420p", "yuv422p", "yuv444p")[chroma_format - 1]
+    if bit_depth != 8:
+        return f"{name}{bit_depth}le"
+    if full_range and chroma_format in jpeg_formats:
+        return "yuvj" + name[3:]
+    return name
+
+
+def video_signal(r: BitReader) -> Tuple[bool, Optional[int]]:
+    """Full range flag and matrix coefficients from video_signal_type, the same in H.264 and HEVC VUI"""
+    if not r.u(1):
+        return False, None
+    r.skip(3)
+    full_range = bool(r.u(1))
+    matrix = None
+    if r.u(1):
+        r.skip(16)
+        matrix = r.u(8)
+    return full_range, matrix
+
+
+def skip_aspect_ratio_and_overscan(r: BitReader):
+    if r.u(1) and r.u(8) == 255:
+        r.skip(32)
+    if r.u(1):
+        r.skip(1)
+
+
+def h264_sps(nal: bytes) -> Tuple[str, Optional[int]]:
+    r = BitReader(nal[1:])
+    profile = r.u(8)
+    r.skip(16)
+    r.ue()
+    chroma_format, bit_depth = 1, 8
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = r.ue()
+        if chroma_format == 3:
+            r.skip(1)
+        bit_depth = r.ue() + 8
+        r.ue()
+        r.skip(1)
+        if r.u(1):
+            for i in range(12 if chroma_format == 3 else 8):
+                if r.u(1):
+                    last = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + r.se()) % 256
+                        last = next_scale or last
+    r.ue()
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.skip(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()
+    r.skip(1)
+    r.ue()
+    r.ue()
+    if not r.u(1):
+        r.skip(1)
+    r.skip(1)
+    if r.u(1):
+        for _ in range(4):
+            r.ue()
+    full_range, matrix = False, None
+    if r.u(1):
+        skip_aspect_ratio_and_overscan(r)
+        full_range, matrix = video_signal(r)
+    return pix_fmt(chroma_format, bit_depth, full_range, matrix, (1, 2, 3)), matrix
+
+
+def hevc_sps(nal: bytes) -> Tuple[str, Optional[int]]:
+    r = BitReader(nal[2:])
+    r.skip(4)
+    max_sub_layers = r.u(3)
+    r.skip(1)
+    # profile_tier_level
+    r.skip(88)
+    r.skip(8)
+    sub_layers = [(r.u(1), r.u(1)) for _ in range(max_sub_layers)]
+    if max_sub_layers:
+        r.skip(2 * (8 - max_sub_layers))
+    for profile_present, level_present in sub_layers:
+        r.skip(88 if profile_present else 0)
+        r.skip(8 if level_present else 0)
+    r.ue()
+    chroma_format = r.ue()
+    if chroma_format == 3:
+        r.skip(1)
+    r.ue()
+    r.ue()
+    if r.u(1):
+        for _ in range(4):
+            r.ue()
+    bit_depth = r.ue() + 8
+    r.ue()
+    log2_max_poc_lsb = r.ue() + 4
+    ordering_all = r.u(1)
+    for _ in range(0 if ordering_all else max_sub_layers, max_sub_layers + 1):
+        r.ue()
+        r.ue()
+        r.ue()
+    for _ in range(6):
+        r.ue()
+    if r.u(1) and r.u(1):
+        for size in range(4):
+            for _ in range(0, 6, 3 if size == 3 else 1):
+                if not r.u(1):
+                    r.ue()
+                else:
+                    if size > 1:
+                        r.se()
+                    for _ in range(min(64, 1 << (4 + (size << 1)))):
+                        r.se()
+    r.skip(2)
+    if r.u(1):
+        r.skip(8)
+        r.ue()
+        r.ue()
+        r.skip(1)
+    # short term reference picture sets, each may be predicted from the one before
+    delta_pocs = []
+    for i in range(r.ue()):
+        if i and r.u(1):
+            r.skip(1)
+            r.ue()
+            count = 0
+            for _ in range(delta_pocs[i - 1] + 1):
+                if r.u(1) or r.u(1):
+                    count += 1
+            delta_pocs.append(count)
+        else:
+            negative, positive = r.ue(), r.ue()
+            for _ in range(negative + positive):
+                r.ue()
+                r.skip(1)
+            delta_pocs.append(negative + positive)
+    if r.u(1):
+        for _ in range(r.ue()):
+            r.skip(log2_max_poc_lsb + 1)
+    r.skip(2)
+    full_range, matrix = False, None
+    if r.u(1):
+        skip_aspect_ratio_and_overscan(r)
+        full_range, matrix = video_signal(r)
+    return pix_fmt(chroma_format, bit_depth, full_range, matrix, (1,)), matrix
+
+
+def avcc_sps(config: bytes) -> bytes:
+    if config[5] & 0x1F == 0:
+        raise Unsupported("no SPS in avcC")
+    length = struct.unpack_from(">H", config, 6)[0]
+    return config[8:8 + length]
+
+
+def hvcc_sps(config: bytes) -> bytes:
+    pos = 23
+    for _ in range(config[22]):
+        nal_type = config[pos] & 0x3F
+        count = struct.unpack_from(">H", config, pos + 1)[0]
+        pos += 3
+        for _ in range(count):
+            length = struct.unpack_from(">H", config, pos)[0]
+            if nal_type == 33:
+                return config[pos + 2:pos + 2 + length]
+            pos += 2 + length
+    raise Unsupported("no SPS in hvcC")
+
+
+def video_format(codec: str, config: Optional[bytes]) -> Tuple[str, Optional[int]]:
+    """Pixel format and colour matrix from the decoder configuration record"""
+    if not config:
+        raise Unsupported("no decoder configuration")
+    if codec == "h264":
+        return h264_sps(avcc_sps(config))
+    return hevc_sps(hvcc_sps(config))
+
+
+def aac_layout(config: Optional[bytes], channels: int) -> str:
+    """Channel layout from an AudioSpecificConfig"""
+    if config:
+        object_type = config[0] >> 3
+        if object_type in (5, 29, 31):
+            # SBR/PS can change the channel count, only the decoder knows
+            raise Unsupported("HE-AAC")
+        frequency_index = ((config[0] & 7) << 1) | (config[1] >> 7)
+        if frequency_index == 15:
+            raise Unsupported("explicit AAC sample rate")
+        channels = (config[1] >> 3) & 0xF
+    if channels not in (1, 2, 6):
+        raise Unsupported("AAC channel configuration")
+    return CHANNEL_LAYOUTS[channels]
+
+
+def ac3_frame(frame: bytes) -> Tuple[str, int, str]:
+    """Channel layout, channel count and bit rate from the header of the first (E-)AC-3 frame"""
+    if frame[:2] != b"\x0b\x77":
+        raise Unsupported("no AC-3 sync word")
+    bsid = frame[5] >> 3
+    if bsid <= 10:
+        fscod, frmsizecod = frame[4] >> 6, frame[4] & 0x3F
+        if fscod == 3 or frmsizecod >= 38:
+            raise Unsupported("bad AC-3 header")
+        r = BitReader(frame[5:8])
+        r.skip(8)
+        acmod = r.u(3)
+        if acmod & 1 and acmod != 1:
+            r.skip(2)
+        if acmod & 4:
+            r.skip(2)
+        if acmod == 2:
+            r.skip(2)
+        lfeon = r.u(1)
+        if (acmod, lfeon) not in AC3_LAYOUTS:
+            raise Unsupported("AC-3 channel mode")
+        return (*AC3_LAYOUTS[(acmod, lfeon)], str(AC3_BIT_RATES[frmsizecod >> 1] * 1000))
+    if bsid > 16:
+        raise Unsupported("unknown AC-3 variant")
+    r = BitReader(frame[2:8])
+    strmtyp = r.u(2)
+    r.skip(3)
+    frame_size = (r.u(11) + 1) * 2
+    fscod = r.u(2)
+    if fscod == 3:
+        sample_rate = AC3_SAMPLE_RATES[r.u(2)] // 2
+        blocks = 6
+    else:
+        sample_rate = AC3_SAMPLE_RATES[fscod]
+        blocks = (1, 2, 3, 6)[r.u(2)]
+    acmod = r.u(3)
+    lfeon = r.u(1)
+    if strmtyp == 1:
+        raise Unsupported("dependent E-AC-3 substream first")
+    # a dependent substream right behind it adds channels the decoder would report
+    dependent = len(frame) > frame_size + 2 and frame[frame_size:frame_size + 2] == b"\x0b\x77" \
+        and frame[frame_size + 2] >> 6 == 1
+    if (acmod, lfeon) not in AC3_LAYOUTS or dependent:
+        raise Unsupported("E-AC-3 channel mode")
+    return (*AC3_LAYOUTS[(acmod, lfeon)], str(8 * frame_size * sample_rate // (blocks * 256)))
+
+
+##
+# Matroska
+##
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+TRACKS = 0x1654AE6B
+TAGS = 0x1254C367
+CLUSTER = 0x1F43B675
+
+
+def vint(data: bytes, pos: int, marker: bool = False) -> Tuple[Optional[int], int]:
+    """Decode an EBML variable length integer, returns the value (None for unknown sizes) and the next position"""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+        if length > 8:
+            raise ValueError("bad EBML vint")
+    value = first if marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if pos + length > len(data):
+        raise IndexError("EBML vint past end of data")
+    if not marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, pos + length
+
+
+def ebml_elements(data: bytes, pos: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+    """Yields (id, start, end) of the elements in data[pos:end]"""
+    end = len(data) if end is None else end
+    while pos < end:
+        element_id, pos = vint(data, pos, marker=True)
+        size, pos = vint(data, pos)
+        if size is None:
+            raise Unsupported("unknown element size")
+        yield element_id, pos, min(pos + size, end)
+        pos += size
+
+
+def ebml_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+
+def ebml_str(data: bytes, start: int, end: int) -> str:
+    return data[start:end].rstrip(b"\0").decode("utf8", errors="replace")
+
+
+def read_element_header(f: BinaryIO) -> Tuple[int, Optional[int]]:
+    header = f.read(12)
+    element_id, pos = vint(header, 0, marker=True)
+    size, pos = vint(header, pos)
+    f.seek(pos - len(header), 1)
+    return element_id, size
+
+
+def read_element(f: BinaryIO, size: Optional[int]) -> bytes:
+    if size is None or size > MAX_HEADER:
+        raise Unsupported("header element too big")
+    data = f.read(size)
+    if len(data) < size:
+        raise Unsupported("truncated file")
+    return data
+
+
+def mkv_track(data: bytes, start: int, end: int) -> Dict:
+    track = {"default": 1, "language": "eng", "codec_private": None, "channels": 1, "strip": b""}
+    for element_id, s, e in ebml_elements(data, start, end):
+        if element_id == 0xD7:
+            track["number"] = ebml_uint(data, s, e)
+        elif element_id == 0x73C5:
+            track["uid"] = ebml_uint(data, s, e)
+        elif element_id == 0x83:
+            track["type"] = ebml_uint(data, s, e)
+        elif element_id == 0x88:
+            track["default"] = ebml_uint(data, s, e)
+        elif element_id == 0x22B59C:
+            track["language"] = ebml_str(data, s, e)
+        elif element_id == 0x536E:
+            track["name"] = ebml_str(data, s, e)
+        elif element_id == 0x86:
+            track["codec_id"] = ebml_str(data, s, e)
+        elif element_id == 0x63A2:
+            track["codec_private"] = data[s:e]
+        elif element_id == 0x23E383:
+            track["default_duration"] = ebml_uint(data, s, e)
+        elif element_id == 0xE0:
+            for child, cs, ce in ebml_elements(data, s, e):
+                if child == 0xB0:
+                    track["width"] = ebml_uint(data, cs, ce)
+                elif child == 0xBA:
+                    track["height"] = ebml_uint(data, cs, ce)
+                elif child == 0x55B0:
+                    for colour, ccs, cce in ebml_elements(data, cs, ce):
+                        if colour == 0x55B1:
+                            track["matrix"] = ebml_uint(data, ccs, cce)
+        elif element_id == 0xE1:
+            for child, cs, ce in ebml_elements(data, s, e):
+                if child == 0x9F:
+                    track["channels"] = ebml_uint(data, cs, ce)
+        elif element_id == 0x6D80:
+            # content encodings, only header stripping can be undone here
+            for _, cs, ce in ebml_elements(data, s, e):
+                for child, ecs, ece in ebml_elements(data, cs, ce):
+                    if child == 0x5035:
+                        raise Unsupported("encrypted track")
+                    if child == 0x5034:
+                        algorithm = 0
+                        for setting, ss, se in ebml_elements(data, ecs, ece):
+                            if setting == 0x4254:
+                                algorithm = ebml_uint(data, ss, se)
+                            elif setting == 0x4255:
+                                track["strip"] = data[ss:se]
+                        if algorithm != 3:
+                            raise Unsupported("compressed track")
+    return track
+
+
+def mkv_tags(data: bytes, tracks: Dict[int, Dict]):
+    """Add stream tags, named the way libavformat names them, to the tracks they target"""
+    for tag_id, start, end in ebml_elements(data):
+        if tag_id != 0x7373:
+            continue
+        uids = []
+        simple_tags = []
+        for element_id, s, e in ebml_elements(data, start, end):
+            if element_id == 0x63C0:
+                uids = [ebml_uint(data, ts, te) for target, ts, te in ebml_elements(data, s, e) if target == 0x63C5]
+            elif element_id == 0x67C8:
+                simple_tags.append((s, e))
+        targets = [tracks[uid] for uid in uids if uid in tracks]
+        for s, e in simple_tags:
+            name = value = None
+            lang, default = "und", 1
+            for element_id, ts, te in ebml_elements(data, s, e):
+                if element_id == 0x45A3:
+                    name = ebml_str(data, ts, te)
+                elif element_id == 0x4487:
+                    value = ebml_str(data, ts, te)
+                elif element_id == 0x447A:
+                    lang = ebml_str(data, ts, te)
+                elif element_id == 0x4484:
+                    default = ebml_uint(data, ts, te)
+            if name is None or value is None:
+                continue
+            for track in targets:
+                if default or lang == "und":
+                    track["tags"][name] = value
+                if lang != "und":
+                    track["tags"][f"{name}-{lang}"] = value
+
+
+def mkv_first_frames(f: BinaryIO, position: int, wanted: Dict[int, Dict]) -> Dict[int, bytes]:
+    """First frame of each wanted track (by track number), from the start of the first cluster on"""
+    frames = {}
+    length = 256 * 1024
+    while True:
+        f.seek(position)
+        data = f.read(length)
+        mkv_scan_blocks(data, wanted, frames)
+        if len(frames) == len(wanted) or len(data) < length or length >= MAX_CLUSTER_SCAN:
+            return frames
+        # interleaving can put the first audio frame far behind the video, look further
+        length *= 4
+
+
+def mkv_scan_blocks(data: bytes, wanted: Dict[int, Dict], frames: Dict[int, bytes]):
+    pos = 0
+    while pos + 16 < len(data) and len(frames) < len(wanted):
+        element_id, pos = vint(data, pos, marker=True)
+        size, pos = vint(data, pos)
+        if element_id in (CLUSTER, 0xA0):
+            # step into clusters and block groups
+            continue
+        if size is None:
+            raise Unsupported("unknown element size in cluster")
+        if pos + size > len(data):
+            return
+        if element_id in (0xA3, 0xA1):
+            number, block = vint(data, pos)
+            track = wanted.get(number)
+            if track is not None and number not in frames:
+                flags = data[block + 2]
+                block += 3
+                lacing = (flags >> 1) & 3
+                if lacing == 1:
+                    count = data[block] + 1
+                    block += 1
+                    for _ in range(count - 1):
+                        while data[block] == 255:
+                            block += 1
+                        block += 1
+                elif lacing == 3:
+                    count = data[block] + 1
+                    block += 1
+                    _, block = vint(data, block)
+                    for _ in range(count - 2):
+                        _, block = vint(data, block)
+                elif lacing == 2:
+                    block += 1
+                frames[number] = track["strip"] + data[block:pos + size]
+        pos += size
+
+
+def mkv_streams(f: BinaryIO) -> List[Dict]:
+    element_id, size = read_element_header(f)
+    if element_id != EBML:
+        raise Unsupported("not an EBML file")
+    f.seek(size, 1)
+    element_id, _ = read_element_header(f)
+    if element_id != SEGMENT:
+        raise Unsupported("no segment")
+    segment = f.tell()
+
+    # the top level elements up to the first cluster, Tags are often at the end so look in the SeekHead too
+    tracks_data = None
+    tags_data = []
+    seek = {}
+    first_cluster = None
+    position = segment
+    while True:
+        f.seek(position)
+        try:
+            element_id, size = read_element_header(f)
+        except IndexError:
+            break
+        if element_id == CLUSTER:
+            first_cluster = position
+            break
+        if size is None:
+            raise Unsupported("unknown element size")
+        if element_id == TRACKS:
+            tracks_data = read_element(f, size)
+        elif element_id == TAGS:
+            tags_data.append(read_element(f, size))
+        elif element_id == SEEKHEAD:
+            data = read_element(f, size)
+            for entry, s, e in ebml_elements(data):
+                if entry != 0x4DBB:
+                    continue
+                target = offset = None
+                for child, cs, ce in ebml_elements(data, s, e):
+                    if child == 0x53AB:
+                        target = ebml_uint(data, cs, ce)
+                    elif child == 0x53AC:
+                        offset = ebml_uint(data, cs, ce)
+                if target is not None and offset is not None:
+                    seek.setdefault(target, offset)
+        position = f.tell() if element_id in (TRACKS, TAGS, SEEKHEAD) else f.tell() + size
+    if tracks_data is None:
+        raise Unsupported("no tracks before the first cluster")
+    if not tags_data and TAGS in seek:
+        f.seek(segment + seek[TAGS])
+        element_id, size = read_element_header(f)
+        if element_id == TAGS:
+            tags_data.append(read_element(f, size))
+
+    tracks = [mkv_track(tracks_data, s, e) for element_id, s, e in ebml_elements(tracks_data) if element_id == 0xAE]
+    for track in tracks:
+        track["tags"] = {}
+        if track["language"] != "und":
+            track["tags"]["language"] = track["language"]
+        if "name" in track:
+            track["tags"]["title"] = track["name"]
+    for data in tags_data:
+        mkv_tags(data, {track["uid"]: track for track in tracks if "uid" in track})
+
+    wanted = {track["number"]: track for track in tracks
+              if track.get("type") == 2 and MKV_CODECS.get(track.get("codec_id")) in ("ac3", "eac3")}
+    frames = mkv_first_frames(f, first_cluster, wanted) if wanted and first_cluster is not None else {}
+
+    streams = []
+    for index, track in enumerate(tracks):
+        codec = MKV_CODECS.get(track.get("codec_id"))
+        if codec is None:
+            raise Unsupported(f"codec {track.get('codec_id')}")
+        stream = {"index": index, "codec_name": codec}
+        if track["type"] == 1:
+            if "default_duration" not in track:
+                raise Unsupported("no default duration")
+            fmt, matrix = video_format(codec, track["codec_private"])
+            if matrix is None or matrix == 2:
+                matrix = track.get("matrix")
+            stream.update(codec_type="video", width=track["width"], height=track["height"], pix_fmt=fmt,
+                          r_frame_rate=frame_rate(1000000000, track["default_duration"]))
+            if matrix in COLOR_SPACES:
+                stream["color_space"] = COLOR_SPACES[matrix]
+        elif track["type"] == 2:
+            stream.update(codec_type="audio", channels=track["channels"])
+            if codec in ("ac3", "eac3"):
+                if track["number"] not in frames:
+                    raise Unsupported("no audio frame found")
+                stream["channel_layout"], stream["channels"], stream["bit_rate"] = ac3_frame(frames[track["number"]])
+            elif codec == "aac":
+                stream["channel_layout"] = aac_layout(track["codec_private"], track["channels"])
+            elif track["channels"] in CHANNEL_LAYOUTS:
+                stream["channel_layout"] = CHANNEL_LAYOUTS[track["channels"]]
+            else:
+                raise Unsupported("channel layout")
+        elif track["type"] == 17:
+            stream["codec_type"] = "subtitle"
+        else:
+            raise Unsupported(f"track type {track['type']}")
+        stream["disposition"] = {"default": 1 if track["default"] else 0}
+        if track["tags"]:
+            stream["tags"] = track["tags"]
+        streams.append(stream)
+    return streams
+
+
+##
+# MP4
+##
+
+def mp4_boxes(data: bytes, pos: int = 0, end: Optional[int] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """Yields (type, start, end) of the boxes in data[pos:end], start being where the payload begins"""
+    end = len(data) if end is None else end
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError("bad box size")
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def mp4_child(data: bytes, start: int, end: int, path: List[bytes]) -> Optional[Tuple[int, int]]:
+    for box_type, s, e in mp4_boxes(data, start, end):
+        if box_type == path[0]:
+            return (s, e) if len(path) == 1 else mp4_child(data, s, e, path[1:])
+    return None
+
+
+def mp4_descriptor(data: bytes, pos: int) -> Tuple[int, int, int]:
+    """Tag, payload start and payload end of an MPEG-4 descriptor"""
+    tag = data[pos]
+    pos += 1
+    size = 0
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        size = (size << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + size
+
+
+def esds_config(data: bytes, start: int, end: int) -> Tuple[Optional[bytes], int]:
+    """Decoder specific info (the AudioSpecificConfig for AAC) and average bit rate from an esds box"""
+    tag, pos, _ = mp4_descriptor(data, start + 4)
+    if tag != 3:
+        raise Unsupported("no ES descriptor")
+    flags = data[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + data[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, _ = mp4_descriptor(data, pos)
+    if tag != 4:
+        raise Unsupported("no decoder config descriptor")
+    if data[pos] not in (0x40, 0x66, 0x67, 0x68):
+        raise Unsupported("not AAC")
+    avg_bit_rate = struct.unpack_from(">I", data, pos + 9)[0]
+    tag, s, e = mp4_descriptor(data, pos + 13)
+    return data[s:e] if tag == 5 else None, avg_bit_rate
+
+
+def mp4_full_box(data: bytes, start: int) -> Tuple[int, int, int]:
+    """Version, flags and payload start of a full box"""
+    version_flags = struct.unpack_from(">I", data, start)[0]
+    return version_flags >> 24, version_flags & 0xFFFFFF, start + 4
+
+
+def mp4_streams(f: BinaryIO) -> List[Dict]:
+    # find moov, skipping over mdat without reading it
+    moov = None
+    position = 0
+    while moov is None:
+        f.seek(position)
+        header = f.read(16)
+        if len(header) < 8:
+            raise Unsupported("no moov box")
+        size, box_type = struct.unpack_from(">I4s", header)
+        payload = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+            payload = 16
+        elif size == 0:
+            size = None
+        if box_type == b"moov":
+            f.seek(position + payload)
+            moov = read_element(f, None if size is None else size - payload)
+        elif size is None or size < payload:
+            raise Unsupported("no moov box")
+        position += size
+
+    mvhd = mp4_child(moov, 0, len(moov), [b"mvhd"])
+    version, _, pos = mp4_full_box(moov, mvhd[0])
+    movie_timescale = struct.unpack_from(">I", moov, pos + (16 if version else 8))[0]
+
+    streams = []
+    for box_type, start, end in mp4_boxes(moov):
+        if box_type == b"mvex":
+            raise Unsupported("fragmented file")
+        if box_type != b"trak":
+            continue
+        stream = mp4_track(f, moov, start, end, movie_timescale)
+        stream["index"] = len(streams)
+        streams.append(stream)
+    return streams
+
+
+def mp4_first_sample(f: BinaryIO, data: bytes, start: int, end: int) -> bytes:
+    """The start of the track's media data, enough for an audio frame header and the one behind it"""
+    stco = mp4_child(data, start, end, [b"stco"])
+    if stco:
+        offset = struct.unpack_from(">I", data, stco[0] + 8)[0]
+    else:
+        co64 = mp4_child(data, start, end, [b"co64"])
+        offset = struct.unpack_from(">Q", data, co64[0] + 8)[0]
+    f.seek(offset)
+    return f.read(8192)
+
+
+def mp4_track(f: BinaryIO, data: bytes, start: int, end: int, movie_timescale: int) -> Dict:
+    tkhd = mp4_child(data, start, end, [b"tkhd"])
+    _, flags, _ = mp4_full_box(data, tkhd[0])
+
+    mdhd = mp4_child(data, start, end, [b"mdia", b"mdhd"])
+    version, _, pos = mp4_full_box(data, mdhd[0])
+    if version:
+        timescale, duration = struct.unpack_from(">IQ", data, pos + 16)
+        pos += 28
+    else:
+        timescale, duration = struct.unpack_from(">II", data, pos + 8)
+        pos += 16
+    packed = struct.unpack_from(">H", data, pos)[0]
+    language = "".join(chr(((packed >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+    # a single edit trims the stream to the edit's length
+    elst = mp4_child(data, start, end, [b"edts", b"elst"])
+    if elst:
+        version, _, pos = mp4_full_box(data, elst[0])
+        entries = struct.unpack_from(">I", data, pos)[0]
+        if entries == 1:
+            edit = struct.unpack_from(">Q" if version else ">I", data, pos + 4)[0]
+            duration = edit * timescale // movie_timescale if movie_timescale else duration
+        elif entries > 1:
+            raise Unsupported("edit list")
+
+    hdlr = mp4_child(data, start, end, [b"mdia", b"hdlr"])
+    handler = data[hdlr[0] + 8:hdlr[0] + 12]
+    tags = {"language": language}
+    handler_name = data[hdlr[0] + 24:hdlr[1]].rstrip(b"\0")
+    if handler_name and handler_name[0] == len(handler_name) - 1:
+        # QuickTime writes a pascal string
+        handler_name = handler_name[1:]
+    if handler_name:
+        tags["handler_name"] = handler_name.decode("utf8", errors="replace")
+    stbl = mp4_child(data, start, end, [b"mdia", b"minf", b"stbl"])
+    stsd = mp4_child(data, stbl[0], stbl[1], [b"stsd"])
+    entry_type, entry_start, entry_end = next(mp4_boxes(data, stsd[0] + 8, stsd[1]))
+    codec = MP4_CODECS.get(entry_type)
+    if codec is None:
+        raise Unsupported(f"codec {entry_type}")
+
+    stsz = mp4_child(data, stbl[0], stbl[1], [b"stsz"])
+    sample_size, samples = struct.unpack_from(">II", data, stsz[0] + 4)
+    if sample_size:
+        data_size = sample_size * samples
+    else:
+        data_size = sum(struct.unpack_from(f">{samples}I", data, stsz[0] + 12))
+
+    stream = {"codec_name": codec}
+    if handler == b"vide":
+        if codec not in ("h264", "hevc"):
+            raise Unsupported("video codec")
+        width, height = struct.unpack_from(">HH", data, entry_start + 24)
+        compressor = data[entry_start + 43:entry_start + 43 + min(data[entry_start + 42], 31)].rstrip(b"\0")
+        if compressor:
+            tags["encoder"] = compressor.decode("utf8", errors="replace")
+        config = mp4_child(data, entry_start + 78, entry_end, [b"avcC" if codec == "h264" else b"hvcC"])
+        fmt, matrix = video_format(codec, data[config[0]:config[1]] if config else None)
+        stts = mp4_child(data, stbl[0], stbl[1], [b"stts"])
+        count = struct.unpack_from(">I", data, stts[0] + 4)[0]
+        runs = [struct.unpack_from(">II", data, stts[0] + 8 + 8 * i) for i in range(count)]
+        if not runs or not (count == 1 or count == 2 and runs[1][0] == 1):
+            raise Unsupported("variable frame rate")
+        if matrix is None or matrix == 2:
+            colr = mp4_child(data, entry_start + 78, entry_end, [b"colr"])
+            if colr and data[colr[0]:colr[0] + 4] in (b"nclx", b"nclc"):
+                matrix = struct.unpack_from(">H", data, colr[0] + 8)[0]
+        stream.update(codec_type="video", width=width, height=height, pix_fmt=fmt,
+                      r_frame_rate=frame_rate(timescale, runs[0][1]))
+        if matrix in COLOR_SPACES:
+            stream["color_space"] = COLOR_SPACES[matrix]
+    elif handler == b"soun":
+        channels = struct.unpack_from(">H", data, entry_start + 16)[0]
+        if codec == "aac":
+            esds = mp4_child(data, entry_start + 28, entry_end, [b"esds"])
+            if esds is None:
+                raise Unsupported("no esds")
+            config, avg_bit_rate = esds_config(data, *esds)
+            stream["channel_layout"] = aac_layout(config, channels)
+            if avg_bit_rate:
+                stream["bit_rate"] = str(avg_bit_rate)
+        elif codec in ("ac3", "eac3"):
+            # the sample entry's channel count is often just 2, the frame header has what the decoder reports
+            stream["channel_layout"], channels, stream["bit_rate"] = ac3_frame(mp4_first_sample(f, data, *stbl))
+        elif channels in CHANNEL_LAYOUTS:
+            stream["channel_layout"] = CHANNEL_LAYOUTS[channels]
+        else:
+            raise Unsupported("channel layout")
+        stream["codec_type"] = "audio"
+        stream["channels"] = channels
+    elif handler in (b"sbtl", b"subt"):
+        stream["codec_type"] = "subtitle"
+    else:
+        raise Unsupported(f"handler {handler}")
+
+    if duration > 0:
+        if "bit_rate" not in stream:
+            # libavformat's average over the whole track
+            stream["bit_rate"] = str(data_size * timescale * 8 // duration)
+        stream["duration"] = "%f" % (duration / timescale)
+    stream["disposition"] = {"default": 1 if flags & 1 else 0}
+    stream["tags"] = tags
+    return stream
@@ -0,0 +1,109 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, List, NamedTuple
+
+##
+# Minimal inotify binding (Linux only) used by mediascan --watch.
+# Watches a set of folder trees and reports changes in debounced batches.
+##
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Event(NamedTuple):
+    path: str
+    mask: int
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.mask & IN_ISDIR)
+
+
+class Watcher:
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders: Dict[int, str] = {}
+        self.overflow = False
+
+    def add(self, folder: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # folder may have vanished already, anything else (like hitting max_user_watches) is worth a mention
+            if err != 2:
+                print(f"Unable to watch {folder}: {os.strerror(err)}")
+            return
+        self.folders[wd] = folder
+
+    def add_tree(self, top: str):
+        self.add(top)
+        for root, folders, _ in os.walk(top):
+            for folder in folders:
+                self.add(os.path.join(root, folder))
+
+    def _read(self, timeout: float) -> List[Event]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buffer = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name) if name else folder
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # new folders need watching too, including whatever was moved in underneath them
+                self.add_tree(path)
+            events.append(Event(path, mask))
+        return events
+
+    def collect(self, debounce: float) -> List[Event]:
+        """Block until something changes, then keep collecting until nothing has happened for debounce seconds"""
+        events = []
+        while not events and not self.overflow:
+            events = self._read(3600)
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < debounce:
+            more = self._read(debounce - (time.monotonic() - quiet_since))
+            if more:
+                events.extend(more)
+                quiet_since = time.monotonic()
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,89 @@
+import bisect
+import itertools
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+##
+# Spreads probes over the disks the files live on. Each device gets at most a few probes at once,
+# and the files waiting for a device go out in one sweep of ascending inode (or path) order,
+# so a pool of spinning disks keeps every disk busy without making any of them seek back and forth.
+##
+
+
+class DeviceStats:
+
+    def __init__(self):
+        self.files = 0
+        self.busy = 0.0
+        self.first: Optional[float] = None
+        self.last = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return self.last - self.first
+
+
+class DeviceScheduler:
+
+    def __init__(self, executor: Executor, workers: int, per_device: int):
+        self.executor = executor
+        # the executor queue is kept empty, so whatever is waiting can still be reordered
+        self.workers = workers
+        self.per_device = per_device
+        self.lock = threading.Lock()
+        # device -> sorted [(order, seq, future, fn, args)], seq keeps equal orders first come first served
+        self.waiting: Dict[Hashable, List[Tuple]] = {}
+        self.running: Dict[Hashable, int] = {}
+        # device -> order of the last file sent, the sweep carries on from there
+        self.position: Dict[Hashable, Tuple] = {}
+        self.total_running = 0
+        self.seq = itertools.count()
+        self.stats: Dict[Hashable, DeviceStats] = {}
+
+    def submit(self, device: Hashable, order, fn: Callable, *args) -> Future:
+        future = Future()
+        with self.lock:
+            bisect.insort(self.waiting.setdefault(device, []), (order, next(self.seq), future, fn, args))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """Start waiting work on the least busy devices until the workers are used up, called with the lock held"""
+        while self.total_running < self.workers:
+            ready = [device for device, waiting in self.waiting.items()
+                     if waiting and self.running.get(device, 0) < self.per_device]
+            if not ready:
+                return
+            device = min(ready, key=lambda d: self.running.get(d, 0))
+            waiting = self.waiting[device]
+            i = bisect.bisect_left(waiting, self.position.get(device, ()))
+            if i == len(waiting):
+                # end of the sweep, start over from the lowest
+                i = 0
+            order, _, future, fn, args = waiting.pop(i)
+            self.position[device] = (order,)
+            self.running[device] = self.running.get(device, 0) + 1
+            self.total_running += 1
+            self.executor.submit(self._run, device, future, fn, args)
+
+    def _run(self, device: Hashable, future: Future, fn: Callable, args: Tuple):
+        start = time.monotonic()
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as ex:
+                    future.set_exception(ex)
+        finally:
+            end = time.monotonic()
+            with self.lock:
+                self.running[device] -= 1
+                self.total_running -= 1
+                stats = self.stats.setdefault(device, DeviceStats())
+                stats.first = start if stats.first is None else min(stats.first, start)
+                stats.files += 1
+                stats.busy += end - start
+                stats.last = end
+                self._dispatch()
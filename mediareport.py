@@ -1,32 +1,70 @@
+import cProfile
+import itertools
 import json
 import os
+import pstats
 import sys
-from typing import Dict, List, Optional
+import time
+from typing import Collection, Dict, Iterator, List, Optional, Set, Tuple
 from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
 import sqlalchemy
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy import select
-from sqlalchemy.orm import Session, relationship, joinedload
-from mediascan import Item, Audio, Path
+from sqlalchemy import select, delete, insert
+from sqlalchemy.orm import Session, relationship
+from mediascan import Base, Item, Audio, Path, SeasonSummary, ShowSummary, upgrade_schema, \
+    backfill_parsed_columns, create_db_engine
+from metrics import Metrics
 import numpy as np
 import re
 import yaml
 
 
-episode_pattern = re.compile(r"S(\d+)E(\d+)", re.IGNORECASE)
-episode_pattern_alt1 = re.compile(r"S(\d+)E(\d+)(-)(\d+)", re.IGNORECASE)
-episode_pattern_alt2 = re.compile(r"S(\d+)((?:E\d+)+)", re.IGNORECASE)
-episode_pattern_alt3 = re.compile(r"S(\d+)E(\d+)(-)E(\d+)", re.IGNORECASE)
-season_pattern = re.compile(r"Season\ (\d+)", re.IGNORECASE)
 show_pattern = re.compile(r"(/.+?)/Season\ \d+", re.IGNORECASE)
 name_pattern = re.compile(r"^/.*/(.+)$", re.IGNORECASE)
 trunc_pattern = re.compile(r"^.*(S\d+E\d+.*)", re.IGNORECASE)
 
-sources = [ "bluray", "dvd", "webdl", "webrip", "sdtv", "hdtv"]
-
-
-def sum_show(show_seasons: List[Item]) -> Dict:
+# number of standard deviations from the season average before a file is called out by -o
+OUTLIER_THRESHOLD = 2.5
+
+# beyond this many folders, load_seasons reads everything and filters as it goes
+MAX_IN_LIST = 1000
+
+# bump whenever the season analysis changes, so stored summaries get rebuilt
+SUMMARY_VERSION = 1
+# how season stats map onto season_summary columns
+SUMMARY_NUMBERS = {"season": "season", "avg": "size_avg", "std": "size_std", "min": "size_min", "max": "size_max",
+                   "bitavg": "bit_avg", "bitstd": "bit_std", "bitmin": "bit_min", "bitmax": "bit_max"}
+SUMMARY_SETS = ["src", "res", "vcodecs", "acodecs", "alang", "clayouts", "pixformats"]
+SUMMARY_COLLECTIONS = SUMMARY_SETS + ["egaps", "oop"]
+# show_summary columns, each the union of its seasons' sets
+SHOW_SETS = ["src", "res", "vcodecs", "pixformats"]
+
+metrics = Metrics("mediareport")
+
+
+def index_shows(stats: Dict[str, Dict]) -> Dict[str, List[Dict]]:
+    """
+    Build the show -> seasons hierarchy from the season stats, keyed by show folder.
+    A season belongs to every show folder it sits beneath, seasons keep the order of stats.
+    """
+    shows = {}
+    for path in stats:
+        match = show_pattern.search(path)
+        if match:
+            shows[match.group(1)] = []
+
+    for path, season in stats.items():
+        # check each parent folder of the season rather than comparing it with every show
+        slash = path.find("/", 1)
+        while slash != -1:
+            seasons = shows.get(path[:slash])
+            if seasons is not None:
+                seasons.append(season)
+            slash = path.find("/", slash + 1)
+    return shows
+
+
+def sum_show(show_seasons: List[Dict]) -> Dict:
     show_summary = {}
     show_summary["src"] = set()
     show_summary["res"] = set()
@@ -41,50 +79,6 @@ def sum_show(show_seasons: List[Item]) -> Dict:
         
     return show_summary
 
-def extract_se(filename):
-    # try spanning patterns (00-01)
-    se_match = episode_pattern_alt1.search(filename)
-    if se_match and se_match.group(3) == "-":
-        s = se_match.group(1)
-        first = se_match.group(2)
-        last = se_match.group(4)
-#        last = re.compile(r"S\d+E\d+-(\d+)").search(filename).group(4)
-        return (int(s), [int(first), int(last)])
-
-    # try spanning patterns (E01-E02)
-    se_match = episode_pattern_alt3.search(filename)
-    if se_match and se_match.group(3) == "-":
-        s = se_match.group(1)
-        first = se_match.group(2)
-        last = se_match.group(4)
-#        last = re.compile(r"S\d+E\d+-(\d+)").search(filename).group(4)
-        return (int(s), [int(first), int(last)])
-
-    # try multi-episode pattern (E01E02E03...)
-    se_match = episode_pattern_alt2.search(filename)
-    if se_match:
-        s = se_match.group(1)
-        all = se_match.group(2)
-        if len(all) > 3:
-            eplist = all[1:].split("E")
-            return (int(s), [int(e) for e in eplist])
-
-    # Lastly, try the typical pattern
-    se_match = episode_pattern.search(filename)
-    if se_match:
-        s = se_match.group(1)
-        ep = se_match.group(2)
-        return (int(s), [int(ep)])
-
-    return ()                        
-
-def extract_src(filename: str) -> Optional[str]:
-    copy = filename.lower()
-    for source in sources:
-        if source in copy:
-            return source
-    return "???"
-
 def mixed_sources(sources) -> bool:                
     if "bluray" in sources and len(sources) > 1:
         return True
@@ -92,6 +86,303 @@ def mixed_sources(sources) -> bool:
         return True
     return False
 
+def load_seasons(session: Session, pathids: Optional[Collection[int]] = None) -> Iterator[Tuple[str, List, Dict[int, List]]]:
+    """
+    Stream every tv folder (or just those in pathids) with its items and their audio tracks, in folder order.
+    Everything comes from two queries sorted the same way and walked in step,
+    rather than a query per folder.
+    """
+    order = (Path.filepath, Path.id, Item.id)
+    where = [Path.mediatype == "tv"]
+    if pathids is not None and len(pathids) <= MAX_IN_LIST:
+        where.append(Item.pathid.in_(pathids))
+    items = session.execute(
+        select(Path.filepath, Path.season.label("path_season"), Item.pathid, Item.id, Item.filename, Item.duration,
+               Item.filesize_mb, Item.fps, Item.bit_rate, Item.width, Item.height, Item.color_space, Item.pix_format,
+               Item.vcodec, Item.display_res, Item.season, Item.episodes, Item.source)
+        .join(Item.path).where(*where).order_by(*order)
+        .execution_options(yield_per=5000))
+    audio = session.execute(
+        select(Audio.itemid, Audio.codec, Audio.lang, Audio.isdefault, Audio.channel_layout)
+        .join(Audio.item).join(Item.path).where(*where).order_by(*order, Audio.id)
+        .execution_options(yield_per=5000))
+    audio_rows = itertools.groupby(audio, key=lambda a: a.itemid)
+    next_audio = next(audio_rows, None)
+
+    for _, folder_items in itertools.groupby(items, key=lambda item: item.pathid):
+        folder_items = list(folder_items)
+        item_audio = {}
+        for item in folder_items:
+            if next_audio and next_audio[0] == item.id:
+                item_audio[item.id] = list(next_audio[1])
+                next_audio = next(audio_rows, None)
+        if pathids is None or folder_items[0].pathid in pathids:
+            yield folder_items[0].filepath, folder_items, item_audio
+
+
+def segment_stats(keys: np.ndarray, values: np.ndarray):
+    """
+    Count, mean, population stddev, max and min of values for each run of equal keys.
+    keys must be sorted. Returns the distinct keys along with the per-key results and
+    each value's deviation from the mean of its group.
+    """
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    means = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(means, counts)
+    stds = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+    maxes = np.maximum.reduceat(values, starts)
+    mins = np.minimum.reduceat(values, starts)
+    return keys[starts], means, stds, maxes, mins, deviations, np.repeat(stds, counts)
+
+
+class LibraryStats:
+    """File sizes and video bitrates of every tv item (or just those in pathids) as flat arrays, sorted by folder"""
+
+    def __init__(self, session: Session, pathids: Optional[Collection[int]] = None):
+        stmt = (select(Item.pathid, Item.id, Item.filesize_mb, Item.bit_rate)
+                .join(Item.path).where(Path.mediatype == "tv"))
+        if pathids is None:
+            rows = session.execute(stmt.order_by(Item.pathid, Item.id)).all()
+        else:
+            # sorted chunks in turn keep the whole sorted by folder
+            rows = []
+            pathids = sorted(pathids)
+            for i in range(0, len(pathids), MAX_IN_LIST):
+                rows.extend(session.execute(stmt.where(Item.pathid.in_(pathids[i:i + MAX_IN_LIST]))
+                                            .order_by(Item.pathid, Item.id)).all())
+        self.pathids = np.array([row.pathid for row in rows], dtype=np.int64)
+        self.itemids = np.array([row.id for row in rows], dtype=np.int64)
+        self.sizes = np.array([row.filesize_mb for row in rows], dtype=np.int64)
+        self.bitrates = np.array([row.bit_rate or 0 for row in rows], dtype=np.int64)
+        # items without a known bitrate are left out of the bitrate numbers
+        self.has_bitrate = self.bitrates > 0
+
+    def season_stats(self) -> Dict[int, Dict]:
+        numbers = {}
+        if len(self.pathids) == 0:
+            return numbers
+
+        for pathid, avg, std, mx, mn in zip(*segment_stats(self.pathids, self.sizes)[:5]):
+            numbers[pathid] = {"std": int(std), "max": mx, "min": mn, "avg": int(avg),
+                               "bitstd": 0, "bitmax": 0, "bitmin": 0, "bitavg": 0}
+
+        if self.has_bitrate.any():
+            bit_stats = segment_stats(self.pathids[self.has_bitrate], self.bitrates[self.has_bitrate])
+            for pathid, avg, std, mx, mn in zip(*bit_stats[:5]):
+                numbers[pathid].update(bitstd=int(std), bitmax=mx, bitmin=mn, bitavg=int(avg))
+        return numbers
+
+    def outliers(self, threshold: float) -> List[Tuple[int, str]]:
+        """Items whose size or bitrate is more than threshold standard deviations from their season's average"""
+        flagged = []
+        if len(self.pathids) == 0:
+            return flagged
+
+        _, _, _, _, _, deviations, stds = segment_stats(self.pathids, self.sizes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            size_z = np.abs(deviations) / stds
+        for itemid in self.itemids[size_z > threshold]:
+            flagged.append((itemid, "size"))
+
+        if self.has_bitrate.any():
+            _, _, _, _, _, deviations, stds = segment_stats(self.pathids[self.has_bitrate],
+                                                           self.bitrates[self.has_bitrate])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                bit_z = np.abs(deviations) / stds
+            for itemid in self.itemids[self.has_bitrate][bit_z > threshold]:
+                flagged.append((itemid, "bitrate"))
+        return flagged
+
+
+def report_outliers(session: Session, library: LibraryStats, threshold: float):
+    flagged = library.outliers(threshold)
+    if not flagged:
+        return
+    ids = [int(itemid) for itemid, _ in flagged]
+    rows = session.execute(select(Item.id, Path.filepath, Item.filename, Item.filesize_mb, Item.bit_rate)
+                           .join(Item.path).where(Item.id.in_(ids))).all()
+    names = {row.id: row for row in rows}
+    print(f"Outliers (more than {threshold} standard deviations from the season average):")
+    for itemid, kind in sorted(flagged, key=lambda f: (names[f[0]].filepath, names[f[0]].filename, f[1])):
+        row = names[itemid]
+        value = f"{row.filesize_mb} mb" if kind == "size" else f"{row.bit_rate} kbps"
+        print(f"   {os.path.join(row.filepath, row.filename)}: {kind} {value}")
+
+
+def analyze_season(path: str, season_nr: int, items: List, item_audio: Dict[int, List], numbers: Dict,
+                   detailsfile=None) -> Tuple[Dict, List[str]]:
+    """
+    Work out the stats of one season folder. Problems are returned as messages rather than
+    printed so they can be stored with the season's summary and replayed on later runs.
+    """
+    messages = []
+    season = { "avg": 0, "src": set(), "res": set(), "vcodecs": set(), "pixformats": set() }
+    try:
+        eplist = []
+        codecs = set()
+        oop = []
+        res = set()
+        src = set()
+        acodecs = set()
+        alang = set()
+        clayouts = set()
+        pixf = set()
+
+        #
+        # process each episode
+        #
+        if detailsfile:
+            detailsfile.write(f"{path}:\n")
+
+        for item in items:
+
+            if detailsfile:
+                detailsfile.write(details(item) + "\n")
+
+            if item.id in item_audio:
+                for a in item_audio[item.id]:
+                    acodecs.add(a.codec)
+                    if a.isdefault:
+                        alang.add(a.lang)
+                    clayouts.add(a.channel_layout)
+            
+            pixf.add(item.pix_format)
+            
+            # season and episode numbers, parsed when the item was scanned
+            if item.episodes:
+                s = item.season
+                e = [int(ep) for ep in item.episodes.split(",")]
+                if season_nr > 0 and season_nr != s:
+                    oop.append(item.filename)
+                eplist.extend(e)
+            else:
+                messages.append(f"  * Unable to parse season/episode(s) from {item.filename} -- skipped")
+                continue
+
+            codecs.add(item.vcodec)
+            res.add(item.display_res)
+            src.add(item.source)
+
+        #
+        # store details
+        #
+        season["season"] = season_nr
+        
+        # file sizes and bitrates, computed for all seasons at once
+        season.update(numbers)
+
+        # the rest
+        mxe = np.max(eplist)
+        egaps = set([e for e in range(1, mxe)]).difference(eplist)
+        season["egaps"] = [str(gap) for gap in egaps]
+        season["src"] = src
+        season["res"] = res
+        season["oop"] = oop
+        season["vcodecs"] = codecs
+        season["acodecs"] = acodecs
+        season["alang"] = alang
+        season["clayouts"] = clayouts
+        season["pixformats"] = pixf
+
+    except Exception as ex:
+#        traceback.print_exc()
+        messages.append(str(ex))
+        messages.append(f"** Unexpected error processing {path} -- skipping")
+    return season, messages
+
+
+def encode_summary(season: Optional[Dict], messages: List[str]) -> Dict:
+    values = {"reported": 0 if season is None else 1, "messages": json.dumps(messages)}
+    if season is not None:
+        for key, column in SUMMARY_NUMBERS.items():
+            if key in season:
+                values[column] = int(season[key])
+        for key in SUMMARY_COLLECTIONS:
+            if key in season:
+                values[key] = json.dumps(list(season[key]))
+    return values
+
+
+def decode_summary(summary: SeasonSummary) -> Tuple[Optional[Dict], List[str]]:
+    messages = json.loads(summary.messages)
+    if not summary.reported:
+        return None, messages
+    season = {}
+    for key, column in SUMMARY_NUMBERS.items():
+        value = getattr(summary, column)
+        if value is not None:
+            season[key] = value
+    for key in SUMMARY_COLLECTIONS:
+        value = getattr(summary, key)
+        if value is not None:
+            season[key] = set(json.loads(value)) if key in SUMMARY_SETS else json.loads(value)
+    return season, messages
+
+
+def load_summaries(session: Session) -> Dict[int, Tuple[int, Optional[Dict], List[str]]]:
+    """Stored season summaries as pathid -> (generation, season stats, messages)"""
+    # summaries of deleted folders are normally removed by the foreign key, but not every database enforces it
+    session.execute(delete(SeasonSummary).where(SeasonSummary.pathid.not_in(select(Path.id))))
+    results = session.scalars(select(SeasonSummary).where(SeasonSummary.version == SUMMARY_VERSION))
+    return {summary.pathid: (summary.generation, *decode_summary(summary)) for summary in results}
+
+
+def save_summaries(session: Session, folders: List, dirty: Set[int], fresh: Dict[int, Tuple[Dict, List[str]]]):
+    """Replace the summaries of recomputed seasons, recording the folder generation they reflect"""
+    generations = {folder.id: folder.generation or 0 for folder in folders}
+    dirty = list(dirty)
+    for i in range(0, len(dirty), MAX_IN_LIST):
+        chunk = dirty[i:i + MAX_IN_LIST]
+        session.execute(delete(SeasonSummary).where(SeasonSummary.pathid.in_(chunk)))
+        rows = []
+        for pathid in chunk:
+            season, messages = fresh.get(pathid, (None, []))
+            rows.append(dict(encode_summary(season, messages), pathid=pathid, generation=generations[pathid],
+                             version=SUMMARY_VERSION))
+        session.execute(insert(SeasonSummary), rows)
+    session.commit()
+
+
+def show_summaries(session: Session, show_index: Dict[str, List[Dict]], changed: Set[str]) -> Dict[str, Dict]:
+    """
+    Show aggregates as show -> summary. Shows with a changed season, or a different number of them,
+    are summed again and stored, the rest are read back from the show_summary table.
+    """
+    existing = {summary.show: summary for summary in session.scalars(select(ShowSummary))}
+    summaries = {}
+    for show, seasons in show_index.items():
+        current = existing.pop(show, None)
+        if current is not None and show not in changed and current.seasons == len(seasons):
+            summaries[show] = {key: set(json.loads(getattr(current, key))) for key in SHOW_SETS}
+            continue
+        summary = summaries[show] = sum_show(seasons)
+        metrics.count("shows_summed")
+        values = {"name": name_pattern.match(show).group(1), "seasons": len(seasons)}
+        values.update({key: json.dumps(sorted(summary[key], key=str)) for key in SHOW_SETS})
+        if current is None:
+            session.add(ShowSummary(show=show, **values))
+        elif any(getattr(current, key) != value for key, value in values.items()):
+            for key, value in values.items():
+                setattr(current, key, value)
+    for stale in existing.values():
+        session.delete(stale)
+    session.commit()
+    return summaries
+
+
+def changed_shows(paths: Collection[str], show_index: Dict[str, List[Dict]]) -> Set[str]:
+    """The shows the given season folders belong to"""
+    shows = set()
+    for path in paths:
+        slash = path.find("/", 1)
+        while slash != -1:
+            if path[:slash] in show_index:
+                shows.add(path[:slash])
+            slash = path.find("/", slash + 1)
+    return shows
+
+
 def details_header() -> str:
     return f"   {'Episode':65} {'Dur':>7} {'Size(mb)':>8} {'FPS':>5} {'Bit Rate'} {'Resolution'} {'Color':>10} {'Pixel Fmt':>12}"
 
@@ -113,7 +404,10 @@ if __name__ == "__main__":
     report_codecs = False
     show_details = False
     show_langdefaults = False
-    
+    show_outliers = False
+    rebuild = False
+    profiler = None
+
     if len(sys.argv) > 1:
         for arg in sys.argv:
             if arg == "-c":
@@ -122,6 +416,13 @@ if __name__ == "__main__":
                 show_details = True
             elif arg == "-l":
                 show_langdefaults = True
+            elif arg == "-o":
+                show_outliers = True
+            elif arg == "-f":
+                rebuild = True
+            elif arg == "--profile":
+                profiler = cProfile.Profile()
+                profiler.enable()
 
     ##
     # load configuration
@@ -136,7 +437,8 @@ if __name__ == "__main__":
     else:
         print("No enabled database configured")
         sys.exit(0)
-        
+
+    metrics.configure(config.get("metrics", {}))
     if os.path.exists("mediaopts.json"):
         with open("mediaopts.json", "r", encoding="utf-8") as mediafile:
             media_options = json.load(mediafile)
@@ -147,141 +449,83 @@ if __name__ == "__main__":
         detailsfile = open("details.txt", "w", encoding="utf-8")
 
     stats = {}
-    engine = create_engine(db_url, echo=False, future=True)
+    engine = create_db_engine(db_url)
+    metrics.watch_engine(engine)
+    upgrade_schema(engine)
+    Base.metadata.create_all(engine)
     with Session(engine) as session:
 
-        results = session.query(Path).filter(Path.mediatype == "tv").order_by("filepath").all()
-        #results = session.query(Item.filepath, sqlalchemy.func.avg(Item.filesize_mb)).filter(Item.mediatype == "tv").group_by(Item.filepath).order_by("filepath").all()
+        # databases scanned by an older mediascan won't have the parsed columns filled in yet
+        backfill_parsed_columns(session)
+
+        # Only seasons whose folder changed since their summary was stored are recomputed.
+        # Details need every item, so they force a full rebuild.
+        with metrics.timer("load"):
+            folders = session.execute(select(Path.id, Path.filepath, Path.generation)
+                                      .where(Path.mediatype == "tv").order_by(Path.filepath, Path.id)).all()
+            summaries = load_summaries(session)
+        if rebuild or show_details:
+            dirty = {folder.id for folder in folders}
+        else:
+            dirty = {folder.id for folder in folders
+                     if folder.id not in summaries or summaries[folder.id][0] != (folder.generation or 0)}
+        metrics.count("folders", len(folders))
+        metrics.count("folders_changed", len(dirty))
+
+        with metrics.timer("stats"):
+            # outliers are looked for across the whole library, otherwise only changed seasons need numbers
+            library = LibraryStats(session, None if show_outliers or len(dirty) == len(folders) else dirty)
+            season_numbers = library.season_stats()
 
         if show_details:
             detailsfile.write(details_header() + "\n")
 
-        for result in results:
-            path = result.filepath
-
-            #print(path)
-
-            try:
-                smatch = season_pattern.search(path)
-                if smatch:
-                    season_nr = int(smatch.group(1))
-                else:
-                    season_nr = 0
-
-                if not season_nr:
-                    continue
-
-                eplist = []
-                sizes = []
-                bitrates = []
-                codecs = set()
-                oop = []
-                res = set()
-                src = set()
-                acodecs = set()
-                alang = set()
-                clayouts = set()
-                pixf = set()
-
-                #
-                # process each episode
-                #
-                items: List[Item] = session.query(Item).options(joinedload(Item.audio)).options(joinedload(Item.subtitle)).filter(Item.path == result).all()
-                if not items:
-                    continue
-
-                stats[path] = { "avg": 0, "src": set(), "res": set(), "vcodecs": set(), "pixformats": set() }
-
-                if show_details:
-                    detailsfile.write(f"{path}:\n")
-
-                for item in items:
-
-                    if show_details:
-                        detailsfile.write(details(item) + "\n")
-
-                    if item.audio:
-                        for a in item.audio:
-                            acodecs.add(a.codec)
-                            if a.isdefault:
-                                alang.add(a.lang)
-                            clayouts.add(a.channel_layout)
-                    
-                    sizes.append(item.filesize_mb)
-                    if item.bit_rate:
-                        bitrates.append(item.bit_rate)
-                    pixf.add(item.pix_format)
-                    
-                    # season and episode numbers
-                    se = extract_se(item.filename)
-                    if len(se) == 2:
-                        s, e = se
-                        if season_nr > 0 and season_nr != s:
-                            oop.append(item.filename)
-                        eplist.extend(e)
-                    else:
-                        print(f"  * Unable to parse season/episode(s) from {item.filename} -- skipped")
+        fresh = {}
+        if dirty:
+            with metrics.timer("analyze"):
+                for path, items, item_audio in load_seasons(session, None if len(dirty) == len(folders) else dirty):
+                    season_nr = items[0].path_season
+                    if not season_nr:
                         continue
-
-                    codecs.add(item.vcodec)
-                    res.add(item.display_res)
-                    src.add(extract_src(item.filename))
-
-                #
-                # store details
-                #
-                stats[path]["season"] = season_nr
-                
-                # file sizes
-                stats[path]["std"] = int(np.std(sizes))
-                stats[path]["max"] = np.max(sizes)
-                stats[path]["min"] = np.min(sizes)
-                stats[path]["avg"] = int(np.average(sizes))
-
-                # bitrates
-                if bitrates and len(bitrates) > 0:
-                    stats[path]["bitstd"] = int(np.std(bitrates))
-                    stats[path]["bitmax"] = np.max(bitrates)
-                    stats[path]["bitmin"] = np.min(bitrates)
-                    stats[path]["bitavg"] = int(np.average(bitrates))
-                else:
-                    stats[path]["bitstd"] = 0
-                    stats[path]["bitmax"] = 0
-                    stats[path]["bitmin"] = 0
-                    stats[path]["bitavg"] = 0
-
-                # the rest
-                mxe = np.max(eplist)
-                egaps = set([e for e in range(1, mxe)]).difference(eplist)
-                stats[path]["egaps"] = [str(gap) for gap in egaps]
-                stats[path]["src"] = src
-                stats[path]["res"] = res
-                stats[path]["oop"] = oop
-                stats[path]["vcodecs"] = codecs
-                stats[path]["acodecs"] = acodecs
-                stats[path]["alang"] = alang
-                stats[path]["clayouts"] = clayouts
-                stats[path]["pixformats"] = pixf
-
-            except Exception as ex:
-#                traceback.print_exc()
-                print(ex)
-                print(f"** Unexpected error processing {path} -- skipping")            
+                    fresh[items[0].pathid] = analyze_season(path, season_nr, items, item_audio,
+                                                            season_numbers[items[0].pathid],
+                                                            detailsfile if show_details else None)
+                    metrics.count("seasons_analyzed")
+                    metrics.count("items_analyzed", len(items))
+            with metrics.timer("save"):
+                save_summaries(session, folders, dirty, fresh)
+
+        # replay everything in folder order, as if each season had just been computed
+        for folder in folders:
+            if folder.id in fresh:
+                season, messages = fresh[folder.id]
+            elif folder.id in summaries and folder.id not in dirty:
+                _, season, messages = summaries[folder.id]
+            else:
+                continue
+            for message in messages:
+                print(message)
+            if season is not None:
+                stats[folder.filepath] = season
 
         #
         # make a list of show titles and do the analysis
         #
 
-        shows = set()
-        for path in stats.keys():
-            match = show_pattern.search(path)
-            if match:
-                shows.add(match.group(1))
+        show_index = index_shows(stats)
+        with metrics.timer("save"):
+            shows = show_summaries(session, show_index,
+                                   changed_shows([folder.filepath for folder in folders if folder.id in dirty],
+                                                 show_index))
+        metrics.count("seasons", len(stats))
+        metrics.count("shows", len(show_index))
+
+        report_start = time.perf_counter()
 
-        for show in sorted(shows):
-            seasons = [v for k,v in stats.items() if k.startswith(show + "/")]
+        for show in sorted(show_index):
+            seasons = show_index[show]
             #print(show)
-            summary = sum_show(seasons)
+            summary = shows[show]
 
             name = name_pattern.match(show).group(1)
 
@@ -364,6 +608,11 @@ if __name__ == "__main__":
                 if len(report) > 0:
                     report = f"   Season {season_nr['season']}\n" + report
                     print(report)
+        metrics.add_time("report", time.perf_counter() - report_start)
+
+        if show_outliers:
+            with metrics.timer("outliers"):
+                report_outliers(session, library, OUTLIER_THRESHOLD)
 
     if show_details:
         detailsfile.close()
@@ -371,3 +620,9 @@ if __name__ == "__main__":
     with open("mediaopts.json", "w", encoding="utf-8") as mediafile:
         json.dump(media_options, mediafile, indent=4)
     print("mediaopts.json updated.")
+
+    metrics.write()
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats("mediareport.prof")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
@@ -1,21 +1,37 @@
 #!python3
 
+import cProfile
 import datetime
+import fnmatch
 import json
+import pstats
+import queue
 import subprocess
 import os
 import sys
 import re
-from typing import Optional, Dict
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional, Dict, Iterator, List, NamedTuple, Tuple
 from functools import cache
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, inspect
-from sqlalchemy.orm import declarative_base, joinedload
-from sqlalchemy import create_engine
-from sqlalchemy import text
+from sqlalchemy import Column, ForeignKey, Integer, BigInteger, String, Text, DateTime, inspect, bindparam
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import create_engine, event
+from sqlalchemy import text, insert, update, delete, select, or_, func
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import Session, relationship
 
 import yaml
 
+import containers
+from inotify import Watcher
+from iosched import DeviceScheduler
+from metrics import Metrics
+from probecache import ProbeCache
+
 EXTENSIONS = [".mkv", ".mp4", ".avi", ".m4v"]
 
 FFPROBE_PATH = "ffprobe"
@@ -26,8 +42,73 @@ SERIES_REGEX = re.compile(r"(.*)\.S(\d+)E(\d+)")
 season_pattern = re.compile(r".*/(.+?)/Season\ \d+", re.IGNORECASE)
 specials_pattern = re.compile(r".*/(.+?)/Specials", re.IGNORECASE)
 display_res = re.compile(r".*(480p|720p|1080p|1440p|2060p|4320p).*")
+season_nr_pattern = re.compile(r"Season\ (\d+)", re.IGNORECASE)
+episode_pattern = re.compile(r"S(\d+)E(\d+)", re.IGNORECASE)
+episode_pattern_alt1 = re.compile(r"S(\d+)E(\d+)(-)(\d+)", re.IGNORECASE)
+episode_pattern_alt2 = re.compile(r"S(\d+)((?:E\d+)+)", re.IGNORECASE)
+episode_pattern_alt3 = re.compile(r"S(\d+)E(\d+)(-)E(\d+)", re.IGNORECASE)
+
+sources = ["bluray", "dvd", "webdl", "webrip", "sdtv", "hdtv"]
 
+# add: skip unchanged folders, deep: check every file, refresh: re-probe every file
 mode = "add"
+jobs = 1
+probe_cache: Optional[ProbeCache] = None
+bulk_writer: Optional["BulkWriter"] = None
+# folders whose items changed since the last commit
+dirty_paths = set()
+# folders the walk listed, and those it couldn't, used to work out what is gone without stat'ing again
+seen_folders = set()
+unreadable_folders = set()
+# list what the purge would remove instead of removing it
+purge_dry_run = False
+# filepath -> path id of recently stored folders, least recently used dropped past PATH_CACHE_SIZE
+path_ids: "OrderedDict[str, int]" = OrderedDict()
+PATH_CACHE_SIZE = 10000
+# ids per DELETE ... WHERE id IN (...) statement
+DELETE_BATCH = 500
+# rows per executemany UPDATE in --retag
+RETAG_BATCH = 1000
+metrics = Metrics("mediascan")
+# --worker name, a worker only scans paths whose host is unset or matches
+worker: Optional[str] = None
+# identifies this process in scan_lease, so no two scanners work on the same root at once, even on one host
+hostname = socket.gethostname()
+lease_owner = f"{hostname}:{os.getpid()}"
+# the --worker name or host, an unfinished run is resumed by the next run of the same scanner
+scanner = hostname
+lease_ttl = 300
+lease_renewed = {}
+# pipeline depths: files waiting for or being probed, and probed folders waiting for the writer thread
+probe_queue = 64
+write_queue = 16
+# commit after this many seconds or stored files, whichever comes first
+commit_interval = 30
+commit_files = 500
+uncommitted_files = 0
+last_commit = time.monotonic()
+# --resume carries on with the last unfinished run, skipping folders it already completed
+resume = False
+run_id: Optional[int] = None
+completed_folders = set()
+# read .mkv/.mp4/.m4v headers in-process instead of running ffprobe, --verify-native runs both and compares
+native_probe = False
+verify_native = False
+NATIVE_EXTENSIONS = (".mkv", ".mp4", ".m4v")
+# probes go out per disk, see the devices section of mediascan.yml
+scheduler: Optional[DeviceScheduler] = None
+# (path prefix, device name) longest first, and whether to ask mergerfs which branch a file is on
+device_names: List[Tuple[str, str]] = []
+mergerfs = False
+probe_order = "inode"
+# seconds before a hanging ffprobe is killed, 0 waits forever
+probe_timeout = 120
+# path -> (size, mtime_ns) of files that failed to probe, skipped until they change
+quarantine: Dict[str, Tuple[int, int]] = {}
+# quarantined files the walk found changed, to be let out if they probe fine now
+retried_failures = set()
+# (path, reason) of the files quarantined during this run
+new_failures: List[Tuple[str, str]] = []
 
 
 class Path(Base):
@@ -37,6 +118,13 @@ class Path(Base):
     filepath = Column(String(200), nullable=False, index=True)
     title = Column(String(200), nullable=True)
     mediatype = Column(String(5), nullable=False)
+    # folder mtime (ns) and number of entries as of the last scan
+    mtime = Column(BigInteger)
+    entries = Column(Integer)
+    # from "Season N" in the folder path, 0 if there isn't one
+    season = Column(Integer, index=True)
+    # bumped whenever items in the folder are added, changed or removed
+    generation = Column(Integer, default=0)
 
 
 class Item(Base):
@@ -57,6 +145,10 @@ class Item(Base):
     tag = Column(String(30))
     display_res = Column(String(10))
     mediatype = Column(String(5), nullable=False)
+    # parsed from the filename at scan time, episodes is a comma separated list and empty if unparseable
+    season = Column(Integer, index=True)
+    episodes = Column(String(100))
+    source = Column(String(10), index=True)
 
     audio = relationship("Audio", back_populates="item", cascade="all, merge, delete-orphan", passive_deletes=True)
     subtitle = relationship("Subtitle", back_populates="item", cascade="all, merge, delete-orphan",
@@ -86,6 +178,197 @@ class Subtitle(Base):
     item = relationship("Item", back_populates="subtitle")
 
 
+##
+# Materialized report results, maintained by mediareport. A season is only recomputed when
+# its folder's generation has moved on from the one its summary was built from.
+##
+class SeasonSummary(Base):
+    __tablename__ = "season_summary"
+    pathid = Column(Integer, ForeignKey("path.id", ondelete='CASCADE'), primary_key=True)
+    generation = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    # 0 if the folder isn't part of the report (no season number)
+    reported = Column(Integer, nullable=False)
+    season = Column(Integer)
+    size_avg = Column(Integer)
+    size_std = Column(Integer)
+    size_min = Column(Integer)
+    size_max = Column(Integer)
+    bit_avg = Column(Integer)
+    bit_std = Column(Integer)
+    bit_min = Column(Integer)
+    bit_max = Column(Integer)
+    # JSON lists
+    egaps = Column(Text)
+    oop = Column(Text)
+    src = Column(Text)
+    res = Column(Text)
+    vcodecs = Column(Text)
+    acodecs = Column(Text)
+    alang = Column(Text)
+    clayouts = Column(Text)
+    pixformats = Column(Text)
+    messages = Column(Text)
+
+
+class ShowSummary(Base):
+    __tablename__ = "show_summary"
+    show = Column(String(200), primary_key=True)
+    name = Column(String(200))
+    seasons = Column(Integer)
+    # JSON lists
+    src = Column(Text)
+    res = Column(Text)
+    vcodecs = Column(Text)
+    pixformats = Column(Text)
+
+
+class ScanLease(Base):
+    __tablename__ = "scan_lease"
+    root = Column(String(200), primary_key=True)
+    owner = Column(String(100), nullable=False)
+    # epoch seconds
+    expires = Column(BigInteger, nullable=False)
+
+
+class ProbeFailure(Base):
+    """Files ffprobe couldn't make sense of, as they were when it failed"""
+    __tablename__ = "probe_failure"
+    id = Column(Integer, primary_key=True)
+    filepath = Column(String(500), nullable=False, unique=True)
+    size = Column(BigInteger, nullable=False)
+    # ns
+    mtime = Column(BigInteger, nullable=False)
+    reason = Column(String(200))
+    failed = Column(DateTime, nullable=False)
+
+
+class ScanRun(Base):
+    __tablename__ = "scan_run"
+    id = Column(Integer, primary_key=True)
+    owner = Column(String(100), nullable=False)
+    scanner = Column(String(100), nullable=False)
+    started = Column(DateTime, nullable=False)
+
+
+class ScanCheckpoint(Base):
+    """Folders whose items are committed, as of the run's last commit"""
+    __tablename__ = "scan_checkpoint"
+    runid = Column(Integer, ForeignKey("scan_run.id", ondelete='CASCADE'), primary_key=True)
+    filepath = Column(String(200), primary_key=True)
+
+
+def create_db_engine(db_url: str):
+    engine = create_engine(db_url, echo=False, future=True)
+    if engine.dialect.name == "sqlite":
+        # SQLite only enforces foreign keys (and so ON DELETE CASCADE) when asked to, per connection
+        event.listen(engine, "connect", lambda dbapi_connection, _: dbapi_connection.execute("PRAGMA foreign_keys=ON"))
+    return engine
+
+
+def upgrade_schema(engine):
+    """Add any columns (and their indexes) introduced since the tables were first created"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            added = set()
+            for column in table.columns:
+                if column.name not in existing:
+                    coltype = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {coltype}"))
+                    added.add(column.name)
+            for index in table.indexes:
+                if added.intersection(column.name for column in index.columns):
+                    index.create(conn)
+
+
+def parse_season(filepath: str) -> int:
+    match = season_nr_pattern.search(filepath)
+    return int(match.group(1)) if match else 0
+
+
+def extract_se(filename):
+    # try spanning patterns (00-01)
+    se_match = episode_pattern_alt1.search(filename)
+    if se_match and se_match.group(3) == "-":
+        s = se_match.group(1)
+        first = se_match.group(2)
+        last = se_match.group(4)
+#        last = re.compile(r"S\d+E\d+-(\d+)").search(filename).group(4)
+        return (int(s), [int(first), int(last)])
+
+    # try spanning patterns (E01-E02)
+    se_match = episode_pattern_alt3.search(filename)
+    if se_match and se_match.group(3) == "-":
+        s = se_match.group(1)
+        first = se_match.group(2)
+        last = se_match.group(4)
+#        last = re.compile(r"S\d+E\d+-(\d+)").search(filename).group(4)
+        return (int(s), [int(first), int(last)])
+
+    # try multi-episode pattern (E01E02E03...)
+    se_match = episode_pattern_alt2.search(filename)
+    if se_match:
+        s = se_match.group(1)
+        all = se_match.group(2)
+        if len(all) > 3:
+            eplist = all[1:].upper().split("E")
+            return (int(s), [int(e) for e in eplist])
+
+    # Lastly, try the typical pattern
+    se_match = episode_pattern.search(filename)
+    if se_match:
+        s = se_match.group(1)
+        ep = se_match.group(2)
+        return (int(s), [int(ep)])
+
+    return ()
+
+
+def extract_src(filename: str) -> Optional[str]:
+    copy = filename.lower()
+    for source in sources:
+        if source in copy:
+            return source
+    return "???"
+
+
+def filename_values(filename: str) -> Dict:
+    """Season, episodes and source parsed from a filename, as stored on the item"""
+    se = extract_se(filename)
+    if len(se) == 2:
+        season, episodes = se
+        return {"season": season, "episodes": ",".join(str(e) for e in episodes), "source": extract_src(filename)}
+    return {"season": None, "episodes": "", "source": extract_src(filename)}
+
+
+def backfill_parsed_columns(session: Session, batch_size: int = 1000):
+    """One-time fill of the parsed filename/path columns for rows stored before they existed"""
+    path_table = Path.__table__
+    folders = session.execute(select(Path.id, Path.filepath).where(Path.season.is_(None))).all()
+    if folders:
+        session.execute(update(path_table).where(path_table.c.id == bindparam("b_id")).values(season=bindparam("b_season")),
+                        [{"b_id": pathid, "b_season": parse_season(filepath)} for pathid, filepath in folders])
+
+    item_table = Item.__table__
+    stmt = update(item_table).where(item_table.c.id == bindparam("b_id")).values(
+        season=bindparam("b_season"), episodes=bindparam("b_episodes"), source=bindparam("b_source"))
+    while True:
+        rows = session.execute(select(Item.id, Item.filename).where(Item.source.is_(None)).limit(batch_size)).all()
+        if not rows:
+            break
+        params = []
+        for itemid, filename in rows:
+            values = filename_values(filename)
+            params.append({"b_id": itemid, "b_season": values["season"], "b_episodes": values["episodes"],
+                           "b_source": values["source"]})
+        session.execute(stmt, params)
+    session.commit()
+
+
 ##
 # Define some helpful views here. They aren't used in the code but they are in the DB to use for additional reporting, dashboards, etc as needed.
 ##
@@ -167,17 +450,220 @@ class MediaInfo:
         return f"{self.path}, {self.vcodec=}, {self.stream=}, {self.res_width}x{self.res_height}, {self.runtime_str()=}, {self.audio=}"
 
 
-def get_filemodtime(p: str):
-    mtime = os.path.getmtime(p)
-    return datetime.datetime.fromtimestamp(mtime)
-
+class ExistingFile(NamedTuple):
+    id: int
+    pathid: int
+    last_modified: datetime.datetime
+
+
+def under(folder: str, recursive: bool = True):
+    """Filter for Path rows of a folder and, optionally, everything beneath it"""
+    if recursive:
+        return or_(Path.filepath == folder, Path.filepath.startswith(folder + "/", autoescape=True))
+    return Path.filepath == folder
+
+
+def load_existing_files(folder: Optional[str] = None, recursive: bool = True) -> Dict[str, ExistingFile]:
+    stmt = select(Path.filepath, Item.filename, Item.id, Item.pathid, Item.last_modified).join(Item.path)
+    if folder:
+        stmt = stmt.where(under(folder, recursive))
+    existing = {}
+    for filepath, filename, itemid, pathid, last_modified in session.execute(stmt.execution_options(yield_per=5000)):
+        existing[os.path.join(filepath, filename)] = ExistingFile(itemid, pathid, last_modified)
+    return existing
+
+
+class FileStat(NamedTuple):
+    """Identity of a media file, taken from a single stat() and passed through probe and store"""
+    root: str
+    filename: str
+    dev: int
+    ino: int
+    size: int
+    mtime: float
+    mtime_ns: int
+
+    @classmethod
+    def from_stat(cls, root: str, filename: str, st: os.stat_result) -> "FileStat":
+        return cls(root, filename, st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_mtime_ns)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, self.filename)
+
+    @property
+    def identity(self) -> Tuple[int, int, int, int]:
+        return self.dev, self.ino, self.size, self.mtime_ns
+
+    @property
+    def last_modified(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.mtime)
+
+
+class Folder(NamedTuple):
+    """A folder found by walk(). Its media files are only stat'ed when files() is called."""
+    path: str
+    mtime: int
+    entries: int
+    media: List[os.DirEntry]
+
+    def files(self) -> List[FileStat]:
+        result = []
+        for entry in self.media:
+            try:
+                result.append(FileStat.from_stat(self.path, entry.name, entry.stat()))
+            except OSError:
+                # broken link or removed while we were looking
+                continue
+        return result
+
+    def unchanged(self) -> bool:
+        """True if the folder's mtime and entry count match what was recorded on the last scan"""
+        return existing_folders.get(self.path) == (self.mtime, self.entries)
+
+
+def read_folder(top: str) -> Optional[Tuple[Folder, List[str]]]:
+    """List a single folder, returning it along with the subfolders to descend into"""
+    try:
+        with metrics.timer("walk"):
+            mtime = os.stat(top).st_mtime_ns
+            with os.scandir(top) as it:
+                entries = list(it)
+    except OSError as ex:
+        print(f"Unable to read {top}: {ex}")
+        unreadable_folders.add(top)
+        return None
 
-def getinfo(filepath: str):
-    args = [FFPROBE_PATH, '-v', '1', '-show_streams', '-print_format', 'json', '-i', filepath]
-    with subprocess.Popen(args, stdout=subprocess.PIPE) as proc:
-        output = proc.stdout.read().decode(encoding='utf8')
-        info = json.loads(output)
-        return parse_ffmpeg_details_json(filepath, info)
+    folders = []
+    media = []
+    for entry in entries:
+        if entry.is_dir():
+            if not entry.is_symlink():
+                folders.append(entry.path)
+        elif not entry.name.startswith(".") and entry.name[-4:] in EXTENSIONS:
+            media.append(entry)
+
+    seen_folders.add(top)
+    metrics.count("folders_walked")
+    metrics.count("files_walked", len(media))
+    return Folder(top, mtime, len(entries), media), folders
+
+
+def walk(top: str) -> Iterator[Folder]:
+    """
+    Replacement for os.walk() built on os.scandir(). Yields each folder with its media files
+    but leaves stat'ing them to the caller. Like os.walk(), symlinked folders are not followed.
+    """
+    result = read_folder(top)
+    if result is None:
+        return
+    folder, subfolders = result
+    yield folder
+    for subfolder in subfolders:
+        yield from walk(subfolder)
+
+
+def load_existing_folders() -> Dict[str, Tuple[int, int]]:
+    stmt = select(Path.filepath, Path.mtime, Path.entries)
+    return {filepath: (mtime, entries) for filepath, mtime, entries in session.execute(stmt)}
+
+
+def mark_folders(folders: List[Folder]):
+    """Record folder mtimes and entry counts once their items are written, so the next scan can skip them"""
+    if not folders:
+        return
+    path_table = Path.__table__
+    stmt = update(path_table).where(path_table.c.filepath == bindparam("b_filepath")).values(
+        mtime=bindparam("b_mtime"), entries=bindparam("b_entries"))
+    session.execute(stmt, [{"b_filepath": f.path, "b_mtime": f.mtime, "b_entries": f.entries} for f in folders])
+    if run_id is not None:
+        # committed along with the items, so a resumed run can trust them
+        session.execute(insert(ScanCheckpoint), [{"runid": run_id, "filepath": f.path} for f in folders])
+
+
+class ProbeError(Exception):
+    pass
+
+
+def load_failures(folder: str) -> Dict[str, Tuple[int, int]]:
+    stmt = select(ProbeFailure.filepath, ProbeFailure.size, ProbeFailure.mtime).where(
+        ProbeFailure.filepath.startswith(folder.rstrip("/") + "/", autoescape=True))
+    return {filepath: (size, mtime) for filepath, size, mtime in session.execute(stmt)}
+
+
+def record_failure(fstat: FileStat, reason: str):
+    """Quarantine a file until its size or mtime changes"""
+    session.execute(delete(ProbeFailure).where(ProbeFailure.filepath == fstat.path))
+    session.execute(insert(ProbeFailure).values(filepath=fstat.path, size=fstat.size, mtime=fstat.mtime_ns,
+                                                reason=reason[:200], failed=datetime.datetime.now()))
+    new_failures.append((fstat.path, reason))
+    metrics.count("quarantined")
+
+
+def getinfo(fstat: FileStat, use_cache: bool = True):
+    info = None
+    if probe_cache and use_cache:
+        info = probe_cache.get(fstat.identity)
+
+    cached = info is not None
+    native = None
+    # cached ffprobe output is as good as a fresh run to verify against
+    if (verify_native or native_probe and not cached) and fstat.path[-4:].lower() in NATIVE_EXTENSIONS:
+        with metrics.timer("native_probe"):
+            native = containers.probe(fstat.path)
+        if native is None:
+            metrics.count("native_unsupported")
+        elif not verify_native:
+            metrics.count("native_probed")
+            info = native
+
+    if info is None:
+        args = [FFPROBE_PATH, '-v', '1', '-show_streams', '-print_format', 'json', '-i', fstat.path]
+        start = time.perf_counter()
+        with subprocess.Popen(args, stdout=subprocess.PIPE) as proc:
+            try:
+                output, _ = proc.communicate(timeout=probe_timeout or None)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                metrics.count("probe_timeouts")
+                raise ProbeError(f"ffprobe timed out after {probe_timeout}s")
+        metrics.observe("ffprobe", time.perf_counter() - start)
+        metrics.count("probed")
+        if proc.returncode:
+            raise ProbeError(f"ffprobe exited with status {proc.returncode}")
+        with metrics.timer("parse"):
+            try:
+                info = json.loads(output.decode(encoding='utf8'))
+            except ValueError as ex:
+                raise ProbeError(f"unreadable ffprobe output: {ex}")
+        if probe_cache and 'streams' in info:
+            probe_cache.put(fstat.identity, info)
+    elif cached:
+        metrics.count("probe_cache_hits")
+
+    with metrics.timer("parse"):
+        minfo = parse_ffmpeg_details_json(fstat.path, info, fstat.size)
+    if verify_native and native is not None:
+        compare_native(fstat, minfo, parse_ffmpeg_details_json(fstat.path, native, fstat.size))
+    return minfo
+
+
+def compare_native(fstat: FileStat, expected: "MediaInfo", actual: "MediaInfo"):
+    """Report where the native parser disagrees with ffprobe, ffprobe's result is the one kept"""
+    if not expected.valid or not actual.valid:
+        differences = [] if expected.valid == actual.valid else [f"valid: ffprobe {expected.valid}, native {actual.valid}"]
+    else:
+        differences = [f"{key}: ffprobe {expected.info.get(key)!r}, native {actual.info.get(key)!r}"
+                       for key in sorted(expected.info.keys() | actual.info.keys())
+                       if expected.info.get(key) != actual.info.get(key)]
+    if differences:
+        metrics.count("native_differed")
+        print(f"native probe differs for {fstat.path}")
+        for difference in differences:
+            print(f"  {difference}")
+    else:
+        metrics.count("native_matched")
 
 
 @cache
@@ -186,153 +672,1014 @@ def compiled_pattern(pattern: str) -> Optional[re.Pattern]:
     return r
 
 
-@cache
-def fetch_or_create_dbpath(filepath: str, mediatype: str):
-    thepath = session.query(Path).filter(Path.filepath == filepath).first()
-    if not thepath:
-        thepath = Path()
-        thepath.filepath = filepath
-        thepath.mediatype = mediatype
-        match = season_pattern.search(filepath)
+def dbpath_id(filepath: str, mediatype: str) -> int:
+    """Id of the Path row of a folder, created if it doesn't exist yet"""
+    pathid = path_ids.get(filepath)
+    if pathid is not None:
+        path_ids.move_to_end(filepath)
+        return pathid
+
+    pathid = session.scalar(select(Path.id).where(Path.filepath == filepath))
+    if pathid is None:
+        title = None
+        match = season_pattern.search(filepath) or specials_pattern.search(filepath)
         if match:
-            thepath.title = match.group(1)
-        else:
-            match = specials_pattern.search(filepath)
-            if match:
-                thepath.title = match.group(1)
+            title = match.group(1)
+        pathid = session.execute(insert(Path).values(filepath=filepath, mediatype=mediatype, title=title,
+                                                     season=parse_season(filepath))).inserted_primary_key[0]
+    path_ids[filepath] = pathid
+    if len(path_ids) > PATH_CACHE_SIZE:
+        path_ids.popitem(last=False)
+    return pathid
+
+
+# numbered group references (\1, \g<1>, (?(1)yes|no)) would point at the wrong group in the combined regex
+NUMBERED_BACKREF = re.compile(r"\\[1-9]|\\g<\d|\(\?\(\d")
+
+
+class TagMatcher:
+    """
+    The tag rules of a path compiled into a single regex of named alternatives. Alternatives are tried
+    in order, so the first rule that matches still wins. Rules that can't be combined (numbered
+    group references, inline flags) are checked one by one instead.
+    """
+
+    def __init__(self, rules: List[Dict]):
+        self.tags = [rule["tag"] for rule in rules]
+        self.patterns = [compiled_pattern(rule["pattern"]) for rule in rules]
+        self.combined = None
+        if rules and not any(NUMBERED_BACKREF.search(rule["pattern"]) for rule in rules):
+            try:
+                self.combined = re.compile("|".join(f"(?P<tag{i}>{rule['pattern']})" for i, rule in enumerate(rules)))
+            except re.error:
+                pass
+
+    def match(self, p: str) -> Optional[str]:
+        if self.combined is not None:
+            m = self.combined.match(p)
+            # the rule's own group is the outermost, so it is always the last one closed
+            return self.tags[int(m.lastgroup[3:])] if m else None
+        for r, tag in zip(self.patterns, self.tags):
+            if r.match(p):
+                return tag
+        return None
+
 
-    return thepath
+tag_matchers: Dict[str, TagMatcher] = {}
 
 
 def match_tag(p: str, path: Dict):
     if "tags" not in path:
         return None
 
-    for tag in path.get("tags"):
-        r = compiled_pattern(tag["pattern"])
-        if r.match(p):
-            return tag["tag"]
-    return None
+    matcher = tag_matchers.get(path["path"])
+    if matcher is None:
+        matcher = tag_matchers[path["path"]] = TagMatcher(path.get("tags"))
+    return matcher.match(p)
+
+
+def item_values(fstat: FileStat, info: MediaInfo, apath: Dict) -> Dict:
+    """Column values for an item row, shared by the ORM and bulk write paths"""
+    return {
+        "vcodec": info.vcodec,
+        "height": info.res_height,
+        "width": info.res_width,
+        "filesize_mb": info.filesize_mb,
+        "fps": info.fps,
+        "color_space": info.color_space,
+        "pix_format": info.pix_fmt,
+        "duration": info.runtime,
+        "bit_rate": info.bit_rate,
+        "last_modified": fstat.last_modified,
+        "tag": match_tag(fstat.path, apath),
+        "display_res": info.display_res,
+        "mediatype": apath["type"],
+        **filename_values(fstat.filename),
+    }
+
+
+def stream_values(info: MediaInfo) -> Tuple[List[Dict], List[Dict]]:
+    """Column values for the audio and subtitle rows of an item"""
+    audio = info.audio
 
+    # make sure there is always a default audio track
+    if len(audio) == 1:
+        audio[0]['default'] = 1
 
-def store(root: str, filename: str, info: MediaInfo, apath: Dict, existing_file=None):
+    audio_rows = [dict(lang=a['lang'], codec=a['format'], channel_layout=a['channel_layout'], isdefault=a['default'],
+                       bit_rate=a['bit_rate']) for a in audio]
+    subtitle_rows = [dict(lang=s['lang'], format=s['format'], isdefault=s['default']) for s in info.subtitle]
+    return audio_rows, subtitle_rows
+
+
+def as_stored(column, value):
+    """A value the way the database hands it back for column, so a probed "448000" equals a stored 448000"""
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type in (str, int) and not isinstance(value, python_type):
+        try:
+            return python_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def changed_values(model, current: Dict, values: Dict) -> Dict:
+    """The values that differ from the current ones of a row"""
+    columns = model.__table__.c
+    return {name: value for name, value in values.items() if as_stored(columns[name], value) != current.get(name)}
+
+
+def diff_streams(model, existing: List[Dict], rows: List[Dict]) -> Tuple[List[Dict], List[Dict], List[int]]:
+    """
+    Match stored audio or subtitle rows (with ids, in id order) with the probed ones by position.
+    Returns the changes to make: updates (with id), inserts and ids to delete.
+    """
+    updates = []
+    for current, values in zip(existing, rows):
+        changed = changed_values(model, current, values)
+        if changed:
+            updates.append(dict(changed, id=current["id"]))
+    inserts = rows[len(existing):]
+    deletes = [current["id"] for current in existing[len(rows):]]
+    # all rows would have been deleted and inserted again
+    metrics.count("writes_avoided", len(existing) + len(rows) - len(updates) - len(inserts) - len(deletes))
+    return updates, inserts, deletes
+
+
+class ItemChanges(NamedTuple):
+    """What re-probing a stored file changed: item columns, and (updates, inserts, deletes) per stream model"""
+    item: Dict
+    streams: Dict
+
+    @property
+    def reported(self) -> bool:
+        """False if nothing the reports look at changed, just the file's modification time"""
+        return bool(self.item.keys() - {"last_modified"}) or any(any(change) for change in self.streams.values())
+
+
+def item_changes(current: Dict, current_streams: Dict, values: Dict, audio_rows: List[Dict],
+                 subtitle_rows: List[Dict]) -> ItemChanges:
+    changed = changed_values(Item, current, values)
+    metrics.count("items_updated" if changed else "writes_avoided")
+    return ItemChanges(changed, {Audio: diff_streams(Audio, current_streams[Audio], audio_rows),
+                                 Subtitle: diff_streams(Subtitle, current_streams[Subtitle], subtitle_rows)})
+
+
+def row_dict(obj) -> Dict:
+    return {column.key: getattr(obj, column.key) for column in obj.__table__.c}
+
+
+def store(fstat: FileStat, info: MediaInfo, apath: Dict, existing_file=None):
     global session
 
     audio = info.audio
     if not audio:
         print(f"Skipping {info.path} due to missing audio track")
-    else:
-        itemid = -1
-        p = os.path.join(root, filename)
-        if existing_file:
-            itemid = existing_file.id
-            dbpath = existing_file.path
-
-        if itemid != -1:
-            item = session.get(Item, itemid)
-            item.audio.clear()
-            item.subtitle.clear()
-            session.flush()
-
-            item.vcodec = info.vcodec
-            item.height = info.res_height
-            item.width = info.res_width
-            item.filesize_mb = info.filesize_mb
-            item.fps = info.fps
-            item.color_space = info.color_space
-            item.pix_format = info.pix_fmt
-            item.duration = info.runtime
-            item.bit_rate = info.bit_rate
-            item.last_modified = get_filemodtime(p)
-            item.tag = match_tag(p, apath)
-            item.display_res = info.display_res
-            item.mediatype = apath["type"]
-
-        else:
-            item = Item()
-
-            thepath = fetch_or_create_dbpath(root, apath["type"])
-            # if not thepath:
-            #     thepath = Path()
-            #     item.path = thepath
-            #     item.path.filepath = root
-            #     item.path.mediatype = path["type"]
-
-            item.path = thepath
-
-            item.filename = filename
-            item.vcodec = info.vcodec
-            item.height = info.res_height
-            item.width = info.res_width
-            item.filesize_mb = info.filesize_mb
-            item.fps = info.fps
-            item.color_space = info.color_space
-            item.pix_format = info.pix_fmt
-            item.duration = info.runtime
-            item.bit_rate = info.bit_rate
-            item.display_res = info.display_res
-            item.mediatype = apath["type"]
-
-            item.last_modified = get_filemodtime(p)
-            item.tag = match_tag(p, apath)
-            session.add(item)
-
-        ###        session.flush()
-
-        # make sure there is always a default audio track
-        if len(audio) == 1:
-            audio[0]['default'] = 1
-
-        for a in audio:
-            a = Audio(lang=a['lang'], codec=a['format'], channel_layout=a['channel_layout'], isdefault=a['default'],
-                      bit_rate=a['bit_rate'])
-            item.audio.append(a)
-
-        for s in info.subtitle:
-            s = Subtitle(lang=s['lang'], format=s['format'], isdefault=s['default'])
-            item.subtitle.append(s)
-
-        #        session.merge(item)
+        return
+
+    values = item_values(fstat, info, apath)
+    audio_rows, subtitle_rows = stream_values(info)
+    if not existing_file:
+        item = Item(filename=fstat.filename, pathid=dbpath_id(fstat.root, apath["type"]), **values)
+        item.audio = [Audio(**a) for a in audio_rows]
+        item.subtitle = [Subtitle(**s) for s in subtitle_rows]
+        session.add(item)
         session.flush()
+        dirty_paths.add(item.pathid)
+        return
+
+    # only write what changed, a remux or tag edit often leaves the streams as they were
+    item = session.get(Item, existing_file.id)
+    collections = {Audio: item.audio, Subtitle: item.subtitle}
+    existing = {model: sorted(collection, key=lambda child: child.id) for model, collection in collections.items()}
+    changes = item_changes(row_dict(item), {model: [row_dict(child) for child in children]
+                                            for model, children in existing.items()},
+                           values, audio_rows, subtitle_rows)
+    for name, value in changes.item.items():
+        setattr(item, name, value)
+    for model, (updates, inserts, deletes) in changes.streams.items():
+        by_id = {child.id: child for child in existing[model]}
+        for update_values in updates:
+            child = by_id[update_values.pop("id")]
+            for name, value in update_values.items():
+                setattr(child, name, value)
+        for child_id in deletes:
+            collections[model].remove(by_id[child_id])
+        collections[model].extend(model(**row) for row in inserts)
+    session.flush()
+    if changes.reported:
+        dirty_paths.add(item.pathid)
+
+
+def update_rows(model, rows: List[Dict]):
+    """UPDATE rows by primary key, one executemany for each set of columns changed"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    for group in groups.values():
+        session.execute(update(model), group)
+
+
+class BulkWriter:
+    """
+    Batched alternative to store(). Probed files are collected and written with executemany
+    INSERT/UPDATE/DELETE statements every batch_size files instead of flushing the session per item.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.inserts = []
+        self.updates = []
+        self.folders = []
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates)
+
+    def add(self, fstat: FileStat, info: MediaInfo, apath: Dict, existing_file=None):
+        if not info.audio:
+            print(f"Skipping {info.path} due to missing audio track")
+            return
 
+        values = item_values(fstat, info, apath)
+        audio_rows, subtitle_rows = stream_values(info)
+        if existing_file:
+            values["id"] = existing_file.id
+            self.updates.append((values, audio_rows, subtitle_rows))
+        else:
+            values["filename"] = fstat.filename
+            self.inserts.append((fstat.root, apath["type"], values, audio_rows, subtitle_rows))
 
-def dig(apath: Dict):
-    global mode
-
-    root = apath["path"]
-
-    for root, _, files in os.walk(root):
-        for file in files:
-            if file.startswith(".") or os.path.isdir(file):
-                continue
-            if file[-4:] in EXTENSIONS:
-                existing_file = None
-                try:
-                    p = os.path.join(root, file)
+        if len(self) >= self.batch_size:
+            self.flush()
 
-                    existing_file = existing_files.pop(p, None)
-                    if existing_file:
-                        # make sure it was changed before we reprocess
+    def flush(self):
+        if self.updates:
+            self._update_items()
 
-                        last_mod = get_filemodtime(p)
-                        db_last_mod = existing_file.last_modified
+        if self.inserts:
+            rows = []
+            for root, mediatype, values, _, _ in self.inserts:
+                values["pathid"] = dbpath_id(root, mediatype)
+                rows.append(values)
+                dirty_paths.add(values["pathid"])
 
-                        if last_mod == db_last_mod:
-                            continue
+            if session.bind.dialect.insert_executemany_returning_sort_by_parameter_order:
+                ids = session.scalars(insert(Item).returning(Item.id, sort_by_parameter_order=True), rows).all()
+            else:
+                ids = [session.execute(insert(Item), row).inserted_primary_key[0] for row in rows]
+            self._insert_streams(ids, [(a, s) for _, _, _, a, s in self.inserts])
+
+        mark_folders(self.folders)
+
+        self.inserts = []
+        self.updates = []
+        self.folders = []
+
+    def _update_items(self):
+        """Compare the batch with what is stored and write only the differences, like store() does"""
+        ids = [values["id"] for values, _, _ in self.updates]
+        current = {row["id"]: row for row in session.execute(select(Item.__table__).where(Item.id.in_(ids))).mappings()}
+        current_streams = {}
+        for model in (Audio, Subtitle):
+            current_streams[model] = {itemid: [] for itemid in ids}
+            for row in session.execute(select(model.__table__).where(model.itemid.in_(ids)).order_by(model.id)).mappings():
+                current_streams[model][row["itemid"]].append(row)
+
+        item_updates = []
+        stream_changes = {Audio: ([], [], []), Subtitle: ([], [], [])}
+        for values, audio_rows, subtitle_rows in self.updates:
+            itemid = values.pop("id")
+            changes = item_changes(current[itemid], {model: current_streams[model][itemid] for model in current_streams},
+                                   values, audio_rows, subtitle_rows)
+            if changes.item:
+                item_updates.append(dict(changes.item, id=itemid))
+            for model, (updates, inserts, deletes) in changes.streams.items():
+                stream_changes[model][0].extend(updates)
+                stream_changes[model][1].extend(dict(row, itemid=itemid) for row in inserts)
+                stream_changes[model][2].extend(deletes)
+            if changes.reported:
+                dirty_paths.add(current[itemid]["pathid"])
+
+        update_rows(Item, item_updates)
+        for model, (updates, inserts, deletes) in stream_changes.items():
+            update_rows(model, updates)
+            delete_ids(model, deletes)
+            if inserts:
+                session.execute(insert(model), inserts)
+
+    @staticmethod
+    def _insert_streams(ids: List[int], streams: List[Tuple[List[Dict], List[Dict]]]):
+        audio_rows = []
+        subtitle_rows = []
+        for itemid, (audio, subtitles) in zip(ids, streams):
+            audio_rows.extend(dict(a, itemid=itemid) for a in audio)
+            subtitle_rows.extend(dict(s, itemid=itemid) for s in subtitles)
+        if audio_rows:
+            session.execute(insert(Audio), audio_rows)
+        if subtitle_rows:
+            session.execute(insert(Subtitle), subtitle_rows)
+
+
+def queue_folder(folder: Folder, apath: Dict, executor: Executor,
+                 slots: Optional[threading.Semaphore] = None) -> Optional[List]:
+    """
+    Work out which files of a folder need probing and submit them, returns the pending probes in
+    directory order or None if the whole folder is skipped. Doesn't touch the database.
+    """
+    if folder.path in completed_folders or mode == "add" and folder.unchanged():
+        # done earlier in a resumed run, or nothing was added, removed or renamed here since the last scan
+        for entry in folder.media:
+            existing_files.pop(entry.path, None)
+            quarantine.pop(entry.path, None)
+        metrics.count("folders_skipped")
+        metrics.count("files_skipped", len(folder.media))
+        return None
 
-                    info = getinfo(p)
-                    if info.valid:
-                        print(f"  {file}")
-                        store(root, file, info, path, existing_file)
-                except Exception as ex:
-                    #                print(" " + os.path.join(root, file))
-                    print(file)
-                    raise ex
+    with metrics.timer("stat"):
+        files = folder.files()
+
+    pending = []
+    for fstat in files:
+        existing_file = existing_files.pop(fstat.path, None)
+        failure = quarantine.pop(fstat.path, None)
+        if failure == (fstat.size, fstat.mtime_ns) and mode != "refresh":
+            metrics.count("quarantine_skipped")
+            continue
+        if failure:
+            retried_failures.add(fstat.path)
+        if existing_file and mode != "refresh":
+            # make sure it was changed before we reprocess
+            if fstat.last_modified == existing_file.last_modified:
+                metrics.count("files_skipped")
+                continue
 
+        pending.append((fstat, existing_file, submit_probe(fstat, executor, slots)))
+    return pending
+
+
+def device_of(fstat: FileStat):
+    """The disk a file is on: a configured name for its path, its mergerfs branch, or else its st_dev"""
+    path = branch = fstat.path
+    if mergerfs:
+        try:
+            # the branch root, e.g. /mnt/disk3, which the names may refer to as well
+            path = branch = os.getxattr(path, "user.mergerfs.basepath").decode()
+        except OSError:
+            branch = None
+    for prefix, name in device_names:
+        if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+            return name
+    if mergerfs and branch is not None:
+        return branch
+    return f"{os.major(fstat.dev)}:{os.minor(fstat.dev)}"
+
+
+def submit_probe(fstat: FileStat, executor: Executor, slots: Optional[threading.Semaphore] = None,
+                 use_cache: bool = True) -> Future:
+    if slots is not None:
+        # backpressure, the walk waits while probe_queue files are still waiting for or in ffprobe
+        with metrics.timer("probe_queue_wait"):
+            slots.acquire()
+    if scheduler is not None:
+        future = scheduler.submit(device_of(fstat), fstat.ino if probe_order == "inode" else fstat.path,
+                                  getinfo, fstat, use_cache)
+    else:
+        future = executor.submit(getinfo, fstat, use_cache)
+    if slots is not None:
+        future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def probe_result(future: Future, lease: Optional[str]) -> "MediaInfo":
+    """Wait for a probe, renewing the lease meanwhile so that a slow file or folder can't lose it"""
+    while True:
+        if lease in lease_renewed and not renew_lease(lease):
+            raise LeaseLost(lease)
+        try:
+            return future.result(timeout=lease_ttl / 6)
+        except FutureTimeoutError:
+            continue
+
+
+def write_folder(folder: Optional[Folder], apath: Dict, pending: List, lease: Optional[str] = None):
+    """
+    Store the probe results of a folder in directory order, then record the folder as scanned.
+    Without a folder the files are stored and nothing is recorded, as for --refresh-where.
+    """
+    global uncommitted_files
+
+    for fstat, existing_file, future in pending:
+        try:
+            with metrics.timer("probe_wait"):
+                info = probe_result(future, lease)
+        except ProbeError as ex:
+            # one bad file shouldn't cost the rest of the scan, anything else (like ffprobe missing) ends it
+            print(f"Unable to probe {fstat.path}: {ex}")
+            metrics.count("probe_errors")
+            record_failure(fstat, str(ex))
+            continue
+        if info.valid:
+            if fstat.path in retried_failures:
+                # changed since it failed and fine now
+                retried_failures.discard(fstat.path)
+                session.execute(delete(ProbeFailure).where(ProbeFailure.filepath == fstat.path))
+            print(f"  {fstat.filename}")
+            with metrics.timer("store"):
+                if bulk_writer is not None:
+                    bulk_writer.add(fstat, info, apath, existing_file)
+                else:
+                    store(fstat, info, apath, existing_file)
+            metrics.count("stored")
+            uncommitted_files += 1
+        else:
+            metrics.count("invalid")
+            record_failure(fstat, "no streams")
+
+    if folder is None:
+        return
+    # folder state must not be recorded before its items are in the database
+    if bulk_writer is not None:
+        bulk_writer.folders.append(folder)
+    else:
+        mark_folders([folder])
+
+
+def process_folder(folder: Folder, apath: Dict, executor: Executor, lease: Optional[str] = None):
+    pending = queue_folder(folder, apath, executor)
+    if pending is not None:
+        write_folder(folder, apath, pending, lease)
+
+
+class Writer(threading.Thread):
+    """
+    The writing end of a dig(). Takes probed folders off a bounded queue in walk order, stores them and
+    commits in batches. While it runs, this thread is the only one using the session.
+    """
+
+    def __init__(self, apath: Dict, lease: Optional[str]):
+        super().__init__(name="writer", daemon=True)
+        self.apath = apath
+        # the root whose lease is kept up while writing, renewed between files and while waiting on them
+        self.lease = lease
+        self.queue = queue.Queue(maxsize=write_queue)
+        self.error: Optional[BaseException] = None
+        self.lease_lost = False
+        # set when the walk should stop, the remaining queue is drained without writing
+        self.stopped = False
+
+    def put(self, folder: Optional[Folder], pending: List):
+        with metrics.timer("write_queue_wait"):
+            self.queue.put((folder, pending))
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            try:
+                work = self.queue.get(timeout=lease_ttl / 6)
+            except queue.Empty:
+                # the walk is taking its time
+                work = ()
+            if work is None:
+                break
+            if self.stopped:
+                continue
+            try:
+                if work:
+                    write_folder(work[0], self.apath, work[1], self.lease)
+                if self.lease in lease_renewed and not renew_lease(self.lease):
+                    raise LeaseLost(self.lease)
+                if uncommitted_files >= commit_files or time.monotonic() - last_commit >= commit_interval:
+                    commit()
+            except LeaseLost:
+                print(f"lost the lease on {self.lease}, stopping")
+                self.lease_lost = self.stopped = True
+            except BaseException as ex:
+                self.error = ex
+                self.stopped = True
+
+        if self.stopped:
+            return
+        try:
+            if bulk_writer is not None:
+                with metrics.timer("store"):
+                    bulk_writer.flush()
+            commit()
+        except BaseException as ex:
+            self.error = ex
+
+
+def prepare_database(engine):
+    """
+    Create missing tables and views, and upgrade old ones. Workers started together against a new
+    database race each other to do this, whoever loses just has another look.
+    """
+    for attempt in range(2):
+        try:
+            upgrade_schema(engine)
+            Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                if not inspect(conn).has_table("item_audio_view"):
+                    conn.execute(text(''.join(item_audio_view_sql)))
+                if not inspect(conn).has_table("item_subtitle_view"):
+                    conn.execute(text(''.join(item_subtitle_view_sql)))
+            return
+        except DBAPIError:
+            if attempt:
+                raise
+
+
+def acquire_lease(root: str) -> bool:
+    """
+    Claim a root for this scanner, or take over a lease that has expired. Both the insert and the
+    takeover are single statements, so only one of several scanners racing for a root can win.
+    """
+    commit()
+    now = int(time.time())
+    try:
+        session.execute(insert(ScanLease).values(root=root, owner=lease_owner, expires=now + lease_ttl))
         session.commit()
-
-
-def parse_ffmpeg_details_json(_path, info):
+    except IntegrityError:
+        rollback()
+        lease_table = ScanLease.__table__
+        result = session.execute(update(lease_table)
+                                 .where(lease_table.c.root == root,
+                                        or_(lease_table.c.owner == lease_owner, lease_table.c.expires < now))
+                                 .values(owner=lease_owner, expires=now + lease_ttl))
+        session.commit()
+        if result.rowcount != 1:
+            # left behind by a scanner on this host that has exited, no need to wait for it to expire
+            owner = session.scalar(select(lease_table.c.owner).where(lease_table.c.root == root))
+            if owner is None or not owner_exited(owner):
+                return False
+            result = session.execute(update(lease_table)
+                                     .where(lease_table.c.root == root, lease_table.c.owner == owner)
+                                     .values(owner=lease_owner, expires=now + lease_ttl))
+            session.commit()
+            if result.rowcount != 1:
+                return False
+    lease_renewed[root] = now
+    return True
+
+
+def owner_exited(owner: str) -> bool:
+    """True if a lease owner is a process on this host that is no longer running"""
+    host, _, pid = owner.rpartition(":")
+    if host != hostname or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def wait_for_lease(root: str):
+    """Take the lease on a root, waiting for whoever holds it to finish with it"""
+    waiting = False
+    while not acquire_lease(root):
+        if not waiting:
+            owner = session.scalar(select(ScanLease.owner).where(ScanLease.root == root))
+            print(f"{root} is being scanned by {owner}, waiting")
+            waiting = True
+        time.sleep(5)
+
+
+def renew_lease(root: str) -> bool:
+    """Extend the lease once a third of it has passed, False if another scanner took it over meanwhile"""
+    now = int(time.time())
+    if now - lease_renewed.get(root, now) < lease_ttl / 3:
+        return True
+    lease_table = ScanLease.__table__
+    result = session.execute(update(lease_table)
+                             .where(lease_table.c.root == root, lease_table.c.owner == lease_owner)
+                             .values(expires=now + lease_ttl))
+    lease_renewed[root] = now
+    commit()
+    return result.rowcount == 1
+
+
+def release_lease(root: str):
+    session.execute(delete(ScanLease).where(ScanLease.root == root, ScanLease.owner == lease_owner))
+    lease_renewed.pop(root, None)
+    session.commit()
+
+
+def handles(apath: Dict) -> bool:
+    return apath.get("enabled", True) and (worker is None or apath.get("host", worker) == worker)
+
+
+def dig(apath: Dict, executor: Executor, lease: Optional[str] = None) -> bool:
+    """
+    Scan everything beneath a path, returns False if it stopped early because the lease was lost.
+    This thread walks and queues probes while a Writer stores the results, so neither waits on the other
+    until one of the queues fills up.
+    """
+    slots = threading.BoundedSemaphore(probe_queue)
+
+    def folders():
+        for folder in walk(apath["path"]):
+            pending = queue_folder(folder, apath, executor, slots)
+            if pending is not None:
+                yield folder, pending
+
+    return write_all(apath, folders(), lease or apath["path"])
+
+
+def write_all(apath: Dict, work: Iterator[Tuple[Optional[Folder], List]], lease: Optional[str]) -> bool:
+    """Hand (folder, pending probes) to a Writer as they come, returns False if the lease was lost"""
+    writer = Writer(apath, lease)
+    writer.start()
+    try:
+        for folder, pending in work:
+            writer.put(folder, pending)
+            if writer.stopped:
+                break
+    except BaseException:
+        writer.stopped = True
+        raise
+    finally:
+        writer.finish()
+    if writer.error is not None:
+        raise writer.error
+    return not writer.lease_lost
+
+
+def delete_ids(model, ids: List[int]):
+    """Delete rows by primary key in batches, audio and subtitle rows go with their items by ON DELETE CASCADE"""
+    for i in range(0, len(ids), DELETE_BATCH):
+        session.execute(delete(model).where(model.id.in_(ids[i:i + DELETE_BATCH])))
+
+
+def delete_items(removed: Dict[str, ExistingFile]):
+    delete_ids(Item, [existing_file.id for existing_file in removed.values()])
+    metrics.count("purged_files", len(removed))
+    dirty_paths.update(existing_file.pathid for existing_file in removed.values())
+    for p in removed:
+        print(f"removed {p} from database")
+
+
+def commit():
+    """Commit, first bumping the change generation of every folder whose items changed since the last commit"""
+    global uncommitted_files, last_commit
+    if dirty_paths:
+        path_table = Path.__table__
+        session.execute(update(path_table).where(path_table.c.id.in_(dirty_paths))
+                        .values(generation=func.coalesce(path_table.c.generation, 0) + 1))
+        dirty_paths.clear()
+    with metrics.timer("commit"):
+        session.commit()
+    # nothing is reused after a commit, don't let the identity map grow with every item stored
+    session.expunge_all()
+    uncommitted_files = 0
+    last_commit = time.monotonic()
+
+
+def rollback():
+    """Roll back, forgetting any path ids cached from the abandoned transaction"""
+    session.rollback()
+    dirty_paths.clear()
+    path_ids.clear()
+
+
+def abandoned_runs() -> List[ScanRun]:
+    """
+    This scanner's unfinished runs whose process is gone, newest first. A run is taken for gone when its
+    process exited, or when it holds no lease and started long enough ago to have taken one.
+    """
+    now = int(time.time())
+    live = set(session.scalars(select(ScanLease.owner).where(ScanLease.expires >= now)))
+    started = datetime.datetime.now() - datetime.timedelta(seconds=lease_ttl)
+    runs = session.scalars(select(ScanRun).where(ScanRun.scanner == scanner).order_by(ScanRun.id.desc()))
+    return [run for run in runs if run.owner != lease_owner and
+            (owner_exited(run.owner) or run.owner not in live and run.started < started)]
+
+
+def start_run():
+    """Carry on with this scanner's last unfinished run when resuming, otherwise start a new one"""
+    global run_id, resume
+    run = None
+    abandoned = abandoned_runs()
+    if resume:
+        run = abandoned[0] if abandoned else None
+        if run is None:
+            print("nothing to resume, starting a new scan")
+        # rescans in watch mode start over
+        resume = False
+
+    if run is None:
+        # whatever an earlier, abandoned run got through is of no use to a new one
+        if abandoned:
+            session.execute(delete(ScanRun).where(ScanRun.id.in_([r.id for r in abandoned])))
+        run = ScanRun(owner=lease_owner, scanner=scanner, started=datetime.datetime.now())
+        session.add(run)
+        session.commit()
+    else:
+        run.owner, run.scanner = lease_owner, scanner
+        session.commit()
+        completed_folders.update(session.scalars(select(ScanCheckpoint.filepath)
+                                                 .where(ScanCheckpoint.runid == run.id)))
+        print(f"resuming the scan started {run.started:%Y-%m-%d %H:%M}, {len(completed_folders)} folders already done")
+    run_id = run.id
+
+
+def finish_run():
+    global run_id
+    # a finished run has nothing left to resume
+    session.execute(delete(ScanCheckpoint).where(ScanCheckpoint.runid == run_id))
+    session.execute(delete(ScanRun).where(ScanRun.id == run_id))
+    run_id = None
+    completed_folders.clear()
+
+
+def delete_tree(folder: str):
+    """Remove a folder that no longer exists, and everything beneath it, from the database"""
+    removed = load_existing_files(folder)
+    if removed:
+        delete_items(removed)
+    session.execute(delete(Path).where(under(folder)))
+    # the cache may still be holding ids of the deleted rows
+    path_ids.clear()
+
+
+def beneath(p: str, folders) -> bool:
+    """True if p is one of the folders or inside one of them"""
+    return any(p == folder.rstrip("/") or p.startswith(folder.rstrip("/") + "/") for folder in folders)
+
+
+def purge(roots: List[str]):
+    """
+    Remove whatever the walk of roots didn't come across from the database. Worked out from what was
+    seen, so nothing is stat'ed again, and anything beneath a folder that couldn't be read is kept.
+    """
+    def gone(folder: str) -> bool:
+        return beneath(folder, roots) and not beneath(folder, unreadable_folders)
+
+    # whatever is remaining in existing_files under a walked root was removed
+    removed = {p: existing_file for p, existing_file in existing_files.items() if gone(os.path.dirname(p))}
+    folders = [(pathid, filepath) for pathid, filepath in session.execute(select(Path.id, Path.filepath))
+               if filepath not in seen_folders and gone(filepath)]
+    # and so were quarantined files the walk didn't come across
+    failures = [p for p in quarantine if gone(os.path.dirname(p))]
+
+    if purge_dry_run:
+        for p in removed:
+            print(f"would remove {p} from database")
+        for p in failures:
+            print(f"would remove {p} from quarantine")
+        for _, filepath in folders:
+            print(f"would remove folder {filepath} from database")
+        return
+
+    if removed:
+        delete_items(removed)
+    if folders:
+        delete_ids(Path, [pathid for pathid, _ in folders])
+        metrics.count("purged_folders", len(folders))
+        for _, filepath in folders:
+            print(f"removed folder {filepath} from database")
+        # the cache may still be holding ids of the deleted rows
+        path_ids.clear()
+    for i in range(0, len(failures), DELETE_BATCH):
+        session.execute(delete(ProbeFailure).where(ProbeFailure.filepath.in_(failures[i:i + DELETE_BATCH])))
+    # items left behind by folders deleted before foreign keys were enforced
+    session.execute(delete(Item).where(Item.pathid.not_in(select(Path.id))))
+
+
+def scan(paths: List[Dict], executor: Executor):
+    global existing_files, existing_folders
+
+    existing_files = {}
+    quarantine.clear()
+    seen_folders.clear()
+    unreadable_folders.clear()
+    start_run()
+
+    roots = []
+    leased = []
+    try:
+        for path in paths:
+            if not handles(path):
+                continue
+            if not acquire_lease(path["path"]):
+                owner = session.scalar(select(ScanLease.owner).where(ScanLease.root == path["path"]))
+                print(f"{path['path']} is being scanned by {owner}, skipping")
+                continue
+            leased.append(path["path"])
+            # index of existing files and database IDs, loaded in advance to speed things up. Only the
+            # columns needed for change detection are fetched, full items are loaded on demand. Loaded
+            # once the lease is held, another scanner may have just finished this root.
+            existing_files.update(load_existing_files(path["path"]))
+            existing_folders = load_existing_folders()
+            quarantine.update(load_failures(path["path"]))
+            print(path["path"])
+            if dig(path, executor):
+                # only a root that was walked to the end can be purged
+                roots.append(path["path"])
+
+        # finally, purge any records in the database the walk no longer found
+        with metrics.timer("purge"):
+            purge(roots)
+        finish_run()
+        commit()
+    finally:
+        # leases are held until the purge is done, whatever else happens.
+        # An interrupted run loses only what was stored since its last commit
+        rollback()
+        for root in leased:
+            release_lease(root)
+    metrics.write()
+
+
+def retag(paths: List[Dict]):
+    """Apply the current tag rules to the items already in the database, without probing anything"""
+    item_table = Item.__table__
+    stmt = update(item_table).where(item_table.c.id == bindparam("b_id")).values(tag=bindparam("b_tag"))
+    for apath in paths:
+        if not handles(apath):
+            continue
+        if not acquire_lease(apath["path"]):
+            owner = session.scalar(select(ScanLease.owner).where(ScanLease.root == apath["path"]))
+            print(f"{apath['path']} is being scanned by {owner}, skipping")
+            continue
+        try:
+            rows = session.execute(select(Item.id, Path.filepath, Item.filename, Item.tag).join(Item.path)
+                                   .where(under(apath["path"])).execution_options(yield_per=5000)).all()
+            changes = []
+            for itemid, filepath, filename, tag in rows:
+                new_tag = match_tag(os.path.join(filepath, filename), apath)
+                if new_tag != tag:
+                    changes.append({"b_id": itemid, "b_tag": new_tag})
+            for i in range(0, len(changes), RETAG_BATCH):
+                session.execute(stmt, changes[i:i + RETAG_BATCH])
+            # tags aren't part of the reports, so no folder generations to bump
+            session.commit()
+            metrics.count("retagged", len(changes))
+            print(f"{apath['path']}: retagged {len(changes)} of {len(rows)} items")
+        finally:
+            rollback()
+            release_lease(apath["path"])
+    metrics.write()
+
+
+REFRESH_FILTERS = ["path", "mediatype", "vcodec", "display_res", "older", "missing"]
+
+
+def refresh_conditions(filters: List[Tuple[str, str]]) -> List:
+    """SQL conditions for --refresh-where filters, all but path (a glob, matched afterwards)"""
+    conditions = []
+    for key, value in filters:
+        if key in ("mediatype", "vcodec", "display_res"):
+            conditions.append(getattr(Item, key) == value)
+        elif key == "older":
+            conditions.append(Item.last_modified < datetime.datetime.fromisoformat(value))
+        elif key == "missing":
+            conditions.append(Item.__table__.c[value].is_(None))
+    return conditions
+
+
+def refresh_where(paths: List[Dict], filters: List[Tuple[str, str]], executor: Executor):
+    """Re-probe just the stored items matching the filters, through the same probe and writer pipeline as a scan"""
+    conditions = refresh_conditions(filters)
+    globs = [value for key, value in filters if key == "path"]
+    for apath in paths:
+        if not handles(apath):
+            continue
+        if not acquire_lease(apath["path"]):
+            owner = session.scalar(select(ScanLease.owner).where(ScanLease.root == apath["path"]))
+            print(f"{apath['path']} is being scanned by {owner}, skipping")
+            continue
+        try:
+            rows = session.execute(select(Path.filepath, Item.filename, Item.id, Item.pathid, Item.last_modified)
+                                   .join(Item.path).where(under(apath["path"]), *conditions)
+                                   .order_by(Path.filepath, Item.filename)).all()
+            targets = [row for row in rows
+                       if all(fnmatch.fnmatchcase(os.path.join(row[0], row[1]), glob) for glob in globs)]
+            print(f"{apath['path']}: refreshing {len(targets)} items")
+            slots = threading.BoundedSemaphore(probe_queue)
+
+            def folders():
+                pending = []
+                for i, (filepath, filename, itemid, pathid, last_modified) in enumerate(targets):
+                    try:
+                        fstat = FileStat.from_stat(filepath, filename, os.stat(os.path.join(filepath, filename)))
+                    except OSError:
+                        # the next scan will purge it
+                        print(f"{os.path.join(filepath, filename)} is gone, skipping")
+                        continue
+                    pending.append((fstat, ExistingFile(itemid, pathid, last_modified),
+                                    # the probe cache would answer for every file unchanged on disk
+                                    submit_probe(fstat, executor, slots, use_cache=False)))
+                    if i + 1 == len(targets) or targets[i + 1][0] != filepath:
+                        yield None, pending
+                        pending = []
+                if pending:
+                    yield None, pending
+
+            write_all(apath, folders(), apath["path"])
+            metrics.count("refreshed", len(targets))
+        finally:
+            rollback()
+            release_lease(apath["path"])
+    metrics.write()
+
+
+def watch(paths: List[Dict], executor: Executor, debounce: float):
+    """Apply changes reported by inotify as they happen, rescanning only the folders affected"""
+    global existing_files, existing_folders, mode
+
+    roots = [apath for apath in paths if handles(apath)]
+    watcher = Watcher()
+    for apath in roots:
+        watcher.add_tree(apath["path"])
+
+    # watches go in first so nothing that happens during the initial scan is missed
+    scan(paths, executor)
+    print("watching for changes...")
+
+    def owner(p: str) -> Optional[Dict]:
+        matches = [apath for apath in roots if p == apath["path"] or p.startswith(apath["path"].rstrip("/") + "/")]
+        return max(matches, key=lambda apath: len(apath["path"]), default=None)
+
+    # events are always checked file by file, an in-place rewrite doesn't change the folder
+    initial_mode = mode
+    mode = "deep"
+
+    while True:
+        events = watcher.collect(debounce)
+        if watcher.overflow:
+            # too much happened at once to trust the events, fall back to a regular scan
+            watcher.overflow = False
+            print("too many changes to track, rescanning")
+            mode = initial_mode
+            scan(paths, executor)
+            mode = "deep"
+            continue
+
+        trees = set()
+        folders = set()
+        for event in events:
+            if event.is_dir:
+                trees.add(event.path)
+            elif event.path[-4:] in EXTENSIONS:
+                folders.add(os.path.dirname(event.path))
+
+        # process new/changed trees top down and skip anything already covered by a parent
+        done = []
+        for top in sorted(trees) + sorted(folders - trees):
+            recursive = top in trees
+            if any(top == d or top.startswith(d + "/") for d in done):
+                continue
+            apath = owner(top)
+            if apath is None:
+                continue
+            if recursive:
+                done.append(top)
+            root = apath["path"]
+            wait_for_lease(root)
+            try:
+                if not os.path.isdir(top):
+                    delete_tree(top)
+                    commit()
+                    continue
+
+                existing_files = load_existing_files(top, recursive)
+                existing_folders = {}
+                quarantine.clear()
+                quarantine.update(load_failures(top))
+                print(top)
+                if recursive:
+                    if not dig(dict(apath, path=top), executor, root):
+                        # whoever took the root over will come across the rest
+                        continue
+                else:
+                    result = read_folder(top)
+                    if result:
+                        process_folder(result[0], apath, executor, root)
+                        if bulk_writer is not None:
+                            bulk_writer.flush()
+
+                # anything left over was deleted or moved away
+                if existing_files:
+                    delete_items(existing_files)
+                commit()
+            finally:
+                rollback()
+                release_lease(root)
+        metrics.write()
+
+
+def parse_ffmpeg_details_json(_path, info, filesize: Optional[int] = None):
     minone = MediaInfo(None)
     minfo = {'audio': [], 'subtitle': []}
     if 'streams' not in info:
@@ -348,7 +1695,9 @@ def parse_ffmpeg_details_json(_path, info):
             minfo['stream'] = str(stream['index'])
             minfo['res_width'] = stream['width']
             minfo['res_height'] = stream['height']
-            minfo['filesize_mb'] = int(os.path.getsize(_path) / (1024 * 1024))
+            if filesize is None:
+                filesize = os.path.getsize(_path)
+            minfo['filesize_mb'] = int(filesize / (1024 * 1024))
             fr_parts = stream['r_frame_rate'].split('/')
             fr = int(int(fr_parts[0]) / int(fr_parts[1]))
             minfo['fps'] = str(fr)
@@ -427,12 +1776,57 @@ def parse_ffmpeg_details_json(_path, info):
 
 if __name__ == "__main__":
 
-    global engine, session, existing_files, mode
-
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "--refresh":
+    cli_jobs = None
+    profiler = None
+    cli_batch_size = None
+    show_cache_stats = False
+    watch_mode = False
+    retag_mode = False
+    refresh_filters = []
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--refresh":
             mode = "refresh"
             print("running in refresh mode")
+        elif arg == "--jobs":
+            cli_jobs = int(next(args))
+        elif arg == "--deep":
+            mode = "deep"
+            print("running in deep mode")
+        elif arg == "--batch-size":
+            cli_batch_size = int(next(args))
+        elif arg == "--probe-cache-stats":
+            show_cache_stats = True
+        elif arg == "--watch":
+            watch_mode = True
+        elif arg == "--retag":
+            retag_mode = True
+        elif arg == "--refresh-where":
+            key, _, value = next(args).partition("=")
+            if key not in REFRESH_FILTERS or not value:
+                print(f"--refresh-where takes one of {', '.join(REFRESH_FILTERS)} as key=value")
+                sys.exit(1)
+            if key == "missing" and value not in Item.__table__.c:
+                print(f"item has no column {value}")
+                sys.exit(1)
+            if key == "older":
+                try:
+                    datetime.datetime.fromisoformat(value)
+                except ValueError:
+                    print(f"--refresh-where older takes a date such as 2024-01-01, not {value}")
+                    sys.exit(1)
+            refresh_filters.append((key, value))
+        elif arg == "--purge-dry-run":
+            purge_dry_run = True
+        elif arg == "--profile":
+            profiler = cProfile.Profile()
+        elif arg == "--resume":
+            resume = True
+        elif arg == "--verify-native":
+            verify_native = True
+        elif arg == "--worker":
+            worker = next(args)
+            scanner = worker
 
     ##
     # load configuration
@@ -440,6 +1834,19 @@ if __name__ == "__main__":
     with open("mediascan.yml", "r") as f:
         config = yaml.load(f, Loader=yaml.Loader)
 
+    cache_config = config.get("probe_cache", {})
+    if cache_config.get("enabled", True):
+        probe_cache = ProbeCache(cache_config.get("path", "mediascan.probecache"), cache_config.get("max_size_mb", 512))
+
+    if show_cache_stats:
+        if not probe_cache:
+            print("Probe cache is disabled")
+            sys.exit(0)
+        for name, value in probe_cache.stats().items():
+            print(f"{name:>14}: {value}")
+        probe_cache.close()
+        sys.exit(0)
+
     for db in config["database"]:
         if db.get("enabled", True):
             db_url = db["connect"]
@@ -452,50 +1859,87 @@ if __name__ == "__main__":
     if len(paths) == 0:
         print("No paths defined to scan")
         sys.exit(0)
-
-    ##
-    # connect to database and create tables, if missing
-    #
-    engine = create_engine(db_url, echo=False, future=True)
-    Base.metadata.create_all(engine)
-
-    with Session(engine) as session:
-
-        if not inspect(engine).has_table("item_audio_view"):
-            session.execute(text(''.join(item_audio_view_sql)))
-
-        if not inspect(engine).has_table("item_subtitle_view"):
-            session.execute(text(''.join(item_subtitle_view_sql)))
-
-        if mode == "refresh":
-            # force everything to re-parse
-            existing_files = {}
-        else:
-            # load all existing files and database IDs in advance to speed things up
-            existing_files = {}
-            #            stmt = select(Item)
-            #            results = session.scalars(stmt)
-            results = session.query(Item).options(joinedload(Item.path)).all()
-
-            for result in results:
-                existing_files[os.path.join(result.path.filepath, result.filename)] = result
-
-        for path in paths:
-            if path.get("enabled", True):
-                print(path["path"])
-                dig(path)
-
-        # finally, purge any records in the database whose file no longer exists
-        # whatever is remaining in existing_files will probably be missing (removed).
-        for p, item in existing_files.items():
-            if not os.path.exists(p):
-                session.delete(item)
-                print(f"removed {p} from database")
-        # and purge missing folders from DB
-        for directory in session.query(Path).all():
-            if not os.path.exists(directory.filepath):
-                session.delete(directory)
-
-        session.commit()
-
-    engine.dispose()
+    for apath in paths:
+        # a trailing slash would hide everything stored beneath the root from under(), leases and the purge
+        apath["path"] = os.path.normpath(apath["path"])
+
+    metrics.configure(config.get("metrics", {}))
+    lease_ttl = config.get("lease_ttl", 300)
+    commit_interval = config.get("commit_interval", 30)
+    commit_files = config.get("commit_files", 500)
+    probe_queue = max(1, config.get("probe_queue", 64))
+    write_queue = max(1, config.get("write_queue", 16))
+    native_probe = config.get("native_probe", False)
+    probe_timeout = config.get("probe_timeout", 120)
+    device_config = config.get("devices", {})
+    device_names = sorted(device_config.get("paths", {}).items(), key=lambda item: len(item[0]), reverse=True)
+    mergerfs = device_config.get("mergerfs", False)
+    probe_order = device_config.get("order", "inode")
+    if profiler:
+        profiler.enable()
+
+    # number of concurrent ffprobe processes
+    jobs = max(1, cli_jobs or config.get("jobs", 1))
+
+    # write new and changed items in batches rather than one ORM flush per item
+    batch_size = cli_batch_size if cli_batch_size is not None else config.get("batch_size", 0)
+    if batch_size > 0:
+        bulk_writer = BulkWriter(batch_size)
+
+    try:
+        ##
+        # connect to database and create tables, if missing
+        #
+        engine = create_db_engine(db_url)
+        metrics.watch_engine(engine)
+        prepare_database(engine)
+
+        with Session(engine) as session:
+
+            backfill_parsed_columns(session)
+
+            if retag_mode:
+                retag(paths)
+            else:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    scheduler = DeviceScheduler(executor, jobs, max(1, device_config.get("probes", jobs)))
+                    if refresh_filters:
+                        refresh_where(paths, refresh_filters, executor)
+                    elif watch_mode:
+                        try:
+                            watch(paths, executor, config.get("watch_debounce", 10))
+                        except KeyboardInterrupt:
+                            print("stopped watching")
+                    else:
+                        scan(paths, executor)
+
+        engine.dispose()
+    finally:
+        if probe_cache:
+            # evicts and saves the hit/miss totals, also when the run fails or is interrupted
+            probe_cache.close()
+
+    if scheduler is not None:
+        for device, stats in sorted(scheduler.stats.items(), key=lambda item: str(item[0])):
+            print(f"device {device}: {stats.files} files in {stats.elapsed:.1f}s, "
+                  f"{stats.files / max(stats.elapsed, 0.001):.1f} files/s, "
+                  f"{stats.busy / stats.files * 1000:.0f} ms per probe")
+
+    skipped = metrics.counters.get("quarantine_skipped", 0)
+    if new_failures or skipped:
+        print(f"quarantine: {len(new_failures)} files failed to probe, {skipped} known bad files skipped")
+        for p, reason in new_failures:
+            print(f"  {p}: {reason}")
+
+    if probe_cache:
+        print(f"probe cache: {probe_cache.hits} hits, {probe_cache.misses} misses")
+
+    if verify_native:
+        counters = metrics.counters
+        print(f"native probe: {counters.get('native_matched', 0)} matched, "
+              f"{counters.get('native_differed', 0)} differed, {counters.get('native_unsupported', 0)} unsupported")
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats("mediascan.prof")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
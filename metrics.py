@@ -0,0 +1,142 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+##
+# Counters, phase timers and latency histograms for mediascan and mediareport.
+# Written at the end of a run as a JSON summary and/or a Prometheus textfile-collector file.
+##
+
+# upper bounds in seconds, a final +Inf bucket is implied
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Histogram:
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class Metrics:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.json_path: Optional[str] = None
+        self.prometheus_path: Optional[str] = None
+        # probe threads record too
+        self.lock = threading.Lock()
+
+    def configure(self, config: Dict):
+        """Set output folders from the metrics section of mediascan.yml, files are named after the script"""
+        if config.get("json"):
+            self.json_path = os.path.join(config["json"], f"{self.name}.json")
+        if config.get("prometheus"):
+            self.prometheus_path = os.path.join(config["prometheus"], f"{self.name}.prom")
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def observe(self, name: str, value: float, buckets: List[float] = LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def watch_engine(self, engine):
+        """Time every statement sent to the database as the db phase and count them as queries"""
+        @event.listens_for(engine, "before_cursor_execute")
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after(conn, cursor, statement, parameters, context, executemany):
+            self.add_time("db", time.perf_counter() - conn.info["metrics_start"].pop())
+            self.count("queries")
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed": round(time.time() - self.started, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {name: round(seconds, 3) for name, seconds in sorted(self.timers.items())},
+                "histograms": {name: {"buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.cumulative())),
+                                      "sum": round(h.sum, 3), "count": h.count}
+                               for name, h in sorted(self.histograms.items())},
+            }
+
+    def prometheus(self) -> str:
+        summary = self.summary()
+        prefix = self.name
+        lines = [f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+                 f"{prefix}_last_run_timestamp_seconds {summary['started']:.0f}",
+                 f"# TYPE {prefix}_run_seconds gauge",
+                 f"{prefix}_run_seconds {summary['elapsed']}"]
+        for name, value in summary["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        if summary["timers"]:
+            lines.append(f"# TYPE {prefix}_phase_seconds_total counter")
+            for name, seconds in summary["timers"].items():
+                lines.append(f'{prefix}_phase_seconds_total{{phase="{name}"}} {seconds}')
+        for name, h in summary["histograms"].items():
+            lines.append(f"# TYPE {prefix}_{name}_seconds histogram")
+            for le, count in h["buckets"].items():
+                lines.append(f'{prefix}_{name}_seconds_bucket{{le="{le}"}} {count}')
+            lines.append(f"{prefix}_{name}_seconds_sum {h['sum']}")
+            lines.append(f"{prefix}_{name}_seconds_count {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Write whichever outputs are configured, replacing the files so readers never see half of one"""
+        outputs = []
+        if self.json_path:
+            outputs.append((self.json_path, json.dumps(self.summary(), indent=2) + "\n"))
+        if self.prometheus_path:
+            outputs.append((self.prometheus_path, self.prometheus()))
+        for path, content in outputs:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp, path)
@@ -0,0 +1,110 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+##
+# Local cache of raw ffprobe output, keyed by file identity (device, inode, size, mtime).
+# As long as a file is untouched its probe results can be re-parsed from here instead
+# of running ffprobe again, so refreshes and database rebuilds only cost disk reads.
+##
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS probe ("
+    " dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL,"
+    " data BLOB NOT NULL, bytes INTEGER NOT NULL, last_used REAL NOT NULL,"
+    " PRIMARY KEY (dev, ino, size, mtime))",
+    "CREATE INDEX IF NOT EXISTS probe_last_used ON probe (last_used)",
+    "CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+]
+
+
+def _timestamp(t: Optional[float]) -> Optional[str]:
+    if t is None:
+        return None
+    return datetime.datetime.fromtimestamp(t).isoformat(" ", "seconds")
+
+
+class ProbeCache:
+
+    def __init__(self, filename: str, max_size_mb: int = 512):
+        self.filename = filename
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # shared by the probe worker threads, access is serialized by self.lock
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for sql in SCHEMA:
+            self.conn.execute(sql)
+
+    def get(self, key: Tuple[int, int, int, int]) -> Optional[Dict]:
+        """Look up probe results by file identity (device, inode, size, mtime in ns)"""
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM probe WHERE dev=? AND ino=? AND size=? AND mtime=?",
+                                    key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE probe SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime=?",
+                              (time.time(), *key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: Tuple[int, int, int, int], info: Dict):
+        data = zlib.compress(json.dumps(info, separators=(",", ":")).encode("utf8"))
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO probe (dev, ino, size, mtime, data, bytes, last_used) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)", (*key, data, len(data), time.time()))
+
+    def size(self) -> int:
+        return self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM probe").fetchone()[0]
+
+    def evict(self) -> int:
+        """Drop least recently used entries until the cache fits in max_size_mb, returns number removed"""
+        with self.lock:
+            excess = self.size() - self.max_bytes
+            if excess <= 0:
+                return 0
+            rows = self.conn.execute("SELECT rowid, bytes FROM probe ORDER BY last_used").fetchall()
+            victims = []
+            for rowid, nbytes in rows:
+                if excess <= 0:
+                    break
+                victims.append((rowid,))
+                excess -= nbytes
+            self.conn.execute("BEGIN")
+            self.conn.executemany("DELETE FROM probe WHERE rowid=?", victims)
+            self.conn.execute("COMMIT")
+        return len(victims)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            entries, nbytes, oldest, newest = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), MIN(last_used), MAX(last_used) FROM probe").fetchone()
+            counters = dict(self.conn.execute("SELECT name, value FROM counter").fetchall())
+        return {
+            "entries": entries,
+            "size_mb": round(nbytes / (1024 * 1024), 2),
+            "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+            "file_size_mb": round(os.path.getsize(self.filename) / (1024 * 1024), 2),
+            "oldest_use": _timestamp(oldest),
+            "newest_use": _timestamp(newest),
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+        }
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            # keep running totals across scans for --probe-cache-stats
+            for name, value in (("hits", self.hits), ("misses", self.misses)):
+                self.conn.execute("INSERT INTO counter (name, value) VALUES (?, ?) "
+                                  "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+            self.conn.close()
@@ -1,5 +1,6 @@
 import unittest
-from mediareport import extract_se, show_pattern, name_pattern
+from mediascan import extract_se, TagMatcher
+from mediareport import show_pattern, name_pattern, index_shows
 
 
 class RegExTests(unittest.TestCase):
@@ -28,6 +29,13 @@ class RegExTests(unittest.TestCase):
         self.assertEqual(len(episodes), 3)
         self.assertEqual(episodes[1], 3)
 
+    def test_alt2_pattern_lowercase(self):
+        results = extract_se("file.s01e02e03.stuff.mkv")
+        self.assertTrue(len(results) == 2)
+        season, episodes = results
+        self.assertEqual(season, 1)
+        self.assertEqual(episodes, [2, 3])
+
     def test_alt3_pattern(self):
         results = extract_se("file.S01E09-E10.stuff.mkv")
         self.assertTrue(len(results) == 2)
@@ -42,5 +50,25 @@ class RegExTests(unittest.TestCase):
         show = name_pattern.search(match.group(1))
         self.assertEqual(show.group(1), "Hello, World")
 
+    def test_show_index(self):
+        stats = {
+            "/tv/Hello/Season 1": {"season": 1},
+            "/tv/Hello/Season 2": {"season": 2},
+            "/tv/Hello World/Season 1": {"season": 3},
+        }
+        shows = index_shows(stats)
+        self.assertEqual(sorted(shows), ["/tv/Hello", "/tv/Hello World"])
+        self.assertEqual([s["season"] for s in shows["/tv/Hello"]], [1, 2])
+        self.assertEqual([s["season"] for s in shows["/tv/Hello World"]], [3])
+
+    def test_tag_rules(self):
+        rules = [{"pattern": r".*/Kids/.*", "tag": "kids"}, {"pattern": r".*\.mkv", "tag": "mkv"}]
+        self.assertEqual(TagMatcher(rules).match("/tv/Kids/a.mkv"), "kids")
+        self.assertEqual(TagMatcher(rules).match("/tv/Other/a.mkv"), "mkv")
+        # group 1 would be another rule's group in the combined regex
+        rules = [{"pattern": r".*/(a)(?(1)x|y)\.mkv", "tag": "A"}, {"pattern": r".*\.mkv", "tag": "B"}]
+        self.assertEqual(TagMatcher(rules).match("/x/ay.mkv"), "B")
+        self.assertEqual(TagMatcher(rules).match("/x/ax.mkv"), "A")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,173 @@
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import mediascan
+from mediascan import Audio, FileStat, Item, Path, Subtitle, parse_ffmpeg_details_json
+from metrics import Metrics
+
+##
+# store() and BulkWriter against in-memory SQLite, fed the same canned ffprobe output
+##
+
+ROOT = "/library/Television/Show/Season 1"
+APATH = {"path": "/library/Television", "type": "tv"}
+
+
+def probe_json(audio=(("eng", "ac3", "448000", 1),), subtitles=("eng",), bit_rate="5000000") -> dict:
+    streams = [{"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080,
+                "r_frame_rate": "24000/1001", "pix_fmt": "yuv420p", "bit_rate": bit_rate, "duration": "2530.0"}]
+    for lang, codec, rate, default in audio:
+        streams.append({"index": len(streams), "codec_type": "audio", "codec_name": codec, "channel_layout": "5.1",
+                        "bit_rate": rate, "disposition": {"default": default}, "tags": {"language": lang}})
+    for lang in subtitles:
+        streams.append({"index": len(streams), "codec_type": "subtitle", "codec_name": "subrip",
+                        "disposition": {"default": 0}, "tags": {"language": lang}})
+    return {"streams": streams}
+
+
+def file_stat(episode: int, mtime: float = 1700000000.0) -> FileStat:
+    filename = f"Show - S01E{episode:02} - Title [Bluray-1080p].mkv"
+    return FileStat(ROOT, filename, 1, episode, 2 * 1024 ** 3, mtime, int(mtime * 1e9))
+
+
+# probed on the first scan, then again after each file changed on disk
+FIRST = [(file_stat(1), probe_json()),
+         (file_stat(2), probe_json(audio=(("eng", "ac3", "448000", 1), ("jpn", "aac", None, 0)))),
+         (file_stat(3), probe_json(subtitles=("eng", "ger")))]
+SECOND = [(file_stat(1, 1700000100.0), probe_json(bit_rate="6000000", audio=(("eng", "eac3", "640000", 1),))),
+          (file_stat(2, 1700000100.0), probe_json()),
+          (file_stat(3, 1700000100.0), probe_json(subtitles=("eng", "ger", "fre")))]
+
+
+class StoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.open_database()
+
+    def tearDown(self):
+        self.session.close()
+        mediascan.session = None
+
+    def open_database(self):
+        engine = mediascan.create_db_engine("sqlite://")
+        mediascan.Base.metadata.create_all(engine)
+        self.session = Session(engine)
+        mediascan.session = self.session
+        mediascan.bulk_writer = None
+        mediascan.metrics = Metrics("mediascan")
+        mediascan.dirty_paths.clear()
+        mediascan.path_ids.clear()
+
+    def scan(self, probed, bulk: bool):
+        """Write one scan's worth of files the way write_folder does, then commit"""
+        existing_files = mediascan.load_existing_files()
+        writer = mediascan.BulkWriter(100) if bulk else None
+        for fstat, output in probed:
+            info = parse_ffmpeg_details_json(fstat.path, output, fstat.size)
+            if writer is not None:
+                writer.add(fstat, info, APATH, existing_files.get(fstat.path))
+            else:
+                mediascan.store(fstat, info, APATH, existing_files.get(fstat.path))
+        if writer is not None:
+            writer.flush()
+        mediascan.commit()
+
+    def rows(self):
+        return {model.__tablename__: [tuple(row) for row in
+                                      self.session.execute(select(model.__table__).order_by(model.id))]
+                for model in (Path, Item, Audio, Subtitle)}
+
+    def stored(self, bulk: bool):
+        """Rows after the first and second scan, each write path getting a database of its own"""
+        self.session.close()
+        self.open_database()
+        self.scan(FIRST, bulk)
+        first = self.rows()
+        self.scan(SECOND, bulk)
+        return first, self.rows()
+
+    def test_bulk_matches_orm(self):
+        orm_first, orm_second = self.stored(bulk=False)
+        bulk_first, bulk_second = self.stored(bulk=True)
+        self.assertEqual(len(orm_first["item"]), 3)
+        self.assertEqual(len(orm_first["audio"]), 4)
+        self.assertEqual(len(orm_second["subtitle"]), 5)
+        self.assertEqual(bulk_first, orm_first)
+        self.assertEqual(bulk_second, orm_second)
+
+    def rescan(self, output, bulk: bool) -> dict:
+        """Store FIRST, then re-probe episode 1 as output after its mtime changed, and return how it was stored"""
+        self.session.close()
+        self.open_database()
+        self.scan(FIRST, bulk)
+        generation = self.session.scalar(select(Path.generation))
+        mediascan.metrics = Metrics("mediascan")
+        self.scan([(file_stat(1, 1700000100.0), output)], bulk)
+        item = self.session.execute(select(Item).where(Item.filename == file_stat(1).filename)).scalar_one()
+        return {"generation": self.session.scalar(select(Path.generation)) - generation,
+                "audio": [(a.id, a.codec, a.bit_rate) for a in sorted(item.audio, key=lambda a: a.id)],
+                "subtitle": [(s.id, s.lang) for s in sorted(item.subtitle, key=lambda s: s.id)],
+                "last_modified": item.last_modified, "counters": mediascan.metrics.counters}
+
+    def test_mtime_only(self):
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk):
+                # the probed bit rate is the string "448000", the stored one the integer 448000
+                result = self.rescan(probe_json(), bulk)
+                self.assertEqual(result["generation"], 0)
+                self.assertEqual(result["last_modified"], file_stat(1, 1700000100.0).last_modified)
+                self.assertEqual(result["audio"], [(1, "ac3", 448000)])
+                self.assertEqual(result["counters"]["items_updated"], 1)
+                self.assertEqual(result["counters"]["writes_avoided"], 4)
+
+    def test_stream_changed(self):
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk):
+                result = self.rescan(probe_json(audio=(("eng", "eac3", "640000", 1),)), bulk)
+                self.assertEqual(result["generation"], 1)
+                # updated where it is, not deleted and inserted again
+                self.assertEqual(result["audio"], [(1, "eac3", 640000)])
+                self.assertEqual(result["counters"]["writes_avoided"], 3)
+
+    def test_stream_added(self):
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk):
+                result = self.rescan(probe_json(audio=(("eng", "ac3", "448000", 1), ("ger", "ac3", "448000", 0))),
+                                     bulk)
+                self.assertEqual(result["generation"], 1)
+                self.assertEqual(result["audio"][0], (1, "ac3", 448000))
+                self.assertEqual(result["audio"][1][1:], ("ac3", 448000))
+                self.assertEqual(result["counters"]["writes_avoided"], 4)
+
+    def test_stream_removed(self):
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk):
+                result = self.rescan(probe_json(subtitles=()), bulk)
+                self.assertEqual(result["generation"], 1)
+                self.assertEqual(result["subtitle"], [])
+                self.assertEqual(result["audio"], [(1, "ac3", 448000)])
+                self.assertEqual(result["counters"]["writes_avoided"], 2)
+
+    def test_streams_matched_by_position(self):
+        existing = [{"id": 7, "itemid": 1, "lang": "eng", "codec": "ac3", "channel_layout": "5.1", "bit_rate": 448000,
+                     "isdefault": 1},
+                    {"id": 9, "itemid": 1, "lang": "jpn", "codec": "aac", "channel_layout": "stereo", "bit_rate": None,
+                     "isdefault": 0}]
+        rows = [dict(lang="jpn", codec="aac", channel_layout="stereo", bit_rate=None, isdefault=0),
+                dict(lang="eng", codec="ac3", channel_layout="5.1", bit_rate="448000", isdefault=1)]
+        updates, inserts, deletes = mediascan.diff_streams(Audio, existing, rows)
+        # swapped tracks are two updates, not a match by content
+        self.assertEqual(updates, [dict(rows[0], id=7), dict(rows[1], id=9)])
+        self.assertEqual((inserts, deletes), ([], []))
+        # deleting both and inserting them again would have been four writes
+        self.assertEqual(mediascan.metrics.counters["writes_avoided"], 2)
+        updates, inserts, deletes = mediascan.diff_streams(Audio, existing, rows[1:])
+        self.assertEqual(updates, [])
+        self.assertEqual(deletes, [9])
+        self.assertEqual(mediascan.metrics.counters["writes_avoided"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()